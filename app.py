@@ -1,39 +1,331 @@
 # app.py - Fixed version for Flask 2.3+
 from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, send_from_directory
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from jinja2 import FileSystemBytecodeCache
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import json
 from datetime import datetime, timedelta
+import atexit
+from contextlib import contextmanager
 import hashlib
+import hmac
 import secrets
 from functools import wraps
 import logging
+import mmap
+import os
+import re
 import time
 import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Database connection to your RDBMS
+from config import DB_BASE_URL
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl; fall back to the in-process lock only
+    fcntl = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes and decodes with orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        # Types orjson can't handle (e.g. Decimal) go through Flask's default
+        return orjson.dumps(obj, default=self.default).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response instead of str round-tripping
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
+
 app = Flask(__name__)
 app.secret_key = 'invoicing-app-secret-key-2024'  # Simple key for development
+app.json = ORJSONProvider(app)
 
-# Database connection to your RDBMS
-DB_API_BASE = 'http://localhost:5000/api'
+# Gzip/brotli responses in-process for when no compressing proxy sits in front
+app.config['COMPRESS_MIN_SIZE'] = 500
+Compress(app)
+
+# Compiled templates are cached on disk and shared by all workers; outside
+# debug mode the template files are not re-checked on every render. With no
+# directory given, Jinja uses a private (0700, owner-checked) per-user temp dir.
+app.config['TEMPLATES_AUTO_RELOAD'] = os.environ.get('FLASK_DEBUG') == '1'
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+
+# Request bodies to MyRDBMS are pre-encoded with orjson
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# How long (seconds) a MyRDBMS health check result is reused
+HEALTH_CHECK_TTL = 2.0
+
+# Queries run concurrently against MyRDBMS by one process: (cores * 2) + 1
+DB_CONCURRENCY = (os.cpu_count() or 1) * 2 + 1
+
+# Seconds to wait for a connection to MyRDBMS; read timeouts are set per call
+DB_CONNECT_TIMEOUT = 5
+
+# Cross-process lock so only one worker at a time runs the schema initialization.
+# It lives in the app's own instance folder rather than the shared temp dir.
+INIT_LOCK_FILE = os.path.join(app.instance_path, 'init.lock')
+
+# How long (seconds) to wait before retrying a failed lazy initialization
+INIT_RETRY_INTERVAL = 30
+
+# Users allowed to re-run schema initialization, e.g. ADMIN_USER_IDS=1,7 (nobody by default)
+ADMIN_USER_IDS = frozenset(int(user_id) for user_id in os.environ.get('ADMIN_USER_IDS', '').split(',') if user_id.strip())
+
+# How long (seconds) a validated session is trusted before re-checking the database
+SESSION_CACHE_TTL = 30
+
+# How long (seconds) list-page totals are reused before counting again. Caches are per
+# worker process and a write only clears the worker that handled it, so other workers can
+# serve stale totals for up to this long; keep it short.
+COUNT_CACHE_TTL = 5
+
+# How long (seconds) a user's customer dropdown list is served from memory (per worker,
+# same staleness bound as COUNT_CACHE_TTL)
+CUSTOMER_OPTIONS_TTL = 5
+
+# How long (seconds) a password verified against Argon2 can be re-checked with a fast hash
+CREDENTIALS_CACHE_TTL = 300
+
+# How many freshly allocated ids an INSERT tries before giving up on duplicate keys
+ID_ALLOCATION_ATTEMPTS = 3
+
+# Invoice numbers look like INV-YYYYMMDD-NNNN
+INVOICE_NUMBER_PREFIX = 'INV-'
+
+# Deepest page reachable by OFFSET; paging on from there goes through the keyset cursor
+MAX_OFFSET_PAGE = 50
+
+# ==================== SQL TEMPLATES ====================
+# Hot-path queries are built once at import. Values are passed separately as
+# params and bound to the ? placeholders by DatabaseManager.execute.
+
+LOGIN_USER_SQL = "SELECT * FROM users WHERE email = ? AND is_active = TRUE"
+
+# Positional INSERT for sessions table
+# Columns: session_id, user_id, created_at, expires_at, ip_address, user_agent
+CREATE_SESSION_SQL = "INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?)"
+
+VALIDATE_SESSION_SQL = """
+    SELECT s.*, u.id as user_id, u.username, u.email, u.full_name, u.company_name
+    FROM sessions s
+    JOIN users u ON s.user_id = u.id
+    WHERE s.session_id = ?
+    AND s.expires_at > ?
+    AND u.is_active = TRUE
+"""
+
+DELETE_SESSION_SQL = "DELETE FROM sessions WHERE session_id = ?"
+
+UPDATE_LAST_LOGIN_SQL = "UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?"
+UPDATE_PASSWORD_HASH_SQL = "UPDATE users SET password_hash = ? WHERE id = ?"
+
+DASHBOARD_CUSTOMER_COUNT_SQL = "SELECT COUNT(*) as customer_count FROM customers WHERE user_id = ?"
+# Invoice count, outstanding and paid totals in a single scan of invoices
+DASHBOARD_INVOICE_STATS_SQL = """
+    SELECT 
+        COUNT(*) as invoice_count,
+        SUM(CASE WHEN status != 'paid' THEN balance_due ELSE 0 END) as total_outstanding,
+        SUM(CASE WHEN status = 'paid' THEN total_amount ELSE 0 END) as total_paid
+    FROM invoices 
+    WHERE user_id = ?
+"""
+# The same stats without CASE, for servers whose aggregates only take a column
+DASHBOARD_INVOICE_COUNT_SQL = "SELECT COUNT(*) as invoice_count FROM invoices WHERE user_id = ?"
+DASHBOARD_OUTSTANDING_SQL = (
+    "SELECT SUM(balance_due) as total_outstanding FROM invoices WHERE user_id = ? AND status != 'paid'"
+)
+DASHBOARD_PAID_SQL = "SELECT SUM(total_amount) as total_paid FROM invoices WHERE user_id = ? AND status = 'paid'"
+DASHBOARD_RECENT_INVOICES_SQL = """
+    SELECT i.id, i.invoice_number, i.issue_date, i.due_date, i.total_amount, i.status, c.name
+    FROM invoices i JOIN customers c ON i.customer_id = c.id
+    WHERE i.user_id = ?
+    ORDER BY i.issue_date DESC, i.id DESC
+    LIMIT 5
+"""
+
+# Id allocation from the id_sequences table
+NEXT_ID_UPDATE_SQL = "UPDATE id_sequences SET last_id = last_id + ? WHERE name = ?"
+NEXT_ID_SELECT_SQL = "SELECT last_id FROM id_sequences WHERE name = ?"
+
+SCHEMA_VERSION_SQL = "SELECT version FROM schema_info WHERE version = ?"
+RECORD_SCHEMA_VERSION_SQL = "INSERT INTO schema_info VALUES (?, CURRENT_TIMESTAMP)"
+
+CUSTOMERS_COUNT_SQL = "SELECT COUNT(*) as total FROM customers {where_clause}"
+# Page rows plus the total match count in one query (needs window function support)
+# Columns the customers page and its edit form use
+CUSTOMER_LIST_COLUMNS = "id, name, email, phone, address, city, country, tax_id, notes"
+CUSTOMERS_PAGE_WITH_TOTAL_SQL = f"""
+    SELECT {CUSTOMER_LIST_COLUMNS}, COUNT(*) OVER() as total FROM customers 
+    {{where_clause}}
+    ORDER BY name, id
+    LIMIT ? OFFSET ?
+"""
+CUSTOMERS_PAGE_SQL = f"""
+    SELECT {CUSTOMER_LIST_COLUMNS} FROM customers 
+    {{where_clause}}
+    ORDER BY name, id
+    LIMIT ? OFFSET ?
+"""
+
+CUSTOMER_OPTIONS_SQL = "SELECT id, name, email FROM customers WHERE user_id = ? ORDER BY name"
+CUSTOMER_OWNER_SQL = "SELECT id FROM customers WHERE id = ? AND user_id = ?"
+INSERT_CUSTOMER_SQL = "INSERT INTO customers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)"
+UPDATE_CUSTOMER_SQL = """
+    UPDATE customers SET
+        name = ?,
+        email = ?,
+        phone = ?,
+        address = ?,
+        city = ?,
+        country = ?,
+        tax_id = ?,
+        notes = ?,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = ?
+"""
+DELETE_CUSTOMER_SQL = "DELETE FROM customers WHERE id = ?"
+
+INVOICE_OWNER_SQL = "SELECT id FROM invoices WHERE id = ? AND user_id = ?"
+INVOICE_NUMBER_COUNT_SQL = "SELECT COUNT(*) as invoice_count FROM invoices WHERE invoice_number LIKE ?"
+INSERT_INVOICE_SQL = """
+    INSERT INTO invoices (
+        id, customer_id, user_id, invoice_number, issue_date, due_date, subtotal, tax_amount,
+        total_amount, amount_paid, balance_due, status, currency, notes, terms, created_at, updated_at
+    ) VALUES (
+        ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+    )
+"""
+INSERT_INVOICE_ITEM_SQL = """
+    INSERT INTO invoice_items (
+        id, invoice_id, description, quantity, unit_price, tax_rate,
+        amount, tax_amount, total_amount, created_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+"""
+DELETE_INVOICE_ITEMS_SQL = "DELETE FROM invoice_items WHERE invoice_id = ?"
+DELETE_INVOICE_SQL = "DELETE FROM invoices WHERE id = ?"
+# Invoice with its customer's details; LEFT JOIN keeps invoices whose customer is gone
+INVOICE_DETAIL_SQL = """
+    SELECT 
+        i.*,
+        c.name as customer_name,
+        c.email as customer_email,
+        c.phone as customer_phone,
+        c.address as customer_address,
+        c.city as customer_city,
+        c.country as customer_country,
+        c.tax_id as customer_tax_id
+    FROM invoices i
+    LEFT JOIN customers c ON i.customer_id = c.id
+    WHERE i.id = ? AND i.user_id = ?
+"""
+JOIN_PROBE_SQL = "SELECT i.id FROM invoices i JOIN customers c ON i.customer_id = c.id LIMIT 1"
+INVOICE_ITEMS_SQL = "SELECT * FROM invoice_items WHERE invoice_id = ? ORDER BY id"
+INVOICE_PAYMENTS_SQL = "SELECT * FROM payments WHERE invoice_id = ? ORDER BY payment_date DESC"
+
+PAYMENTS_PAGE_SQL = """
+    SELECT 
+        p.id,
+        p.invoice_id,
+        p.amount,
+        p.payment_method,
+        p.reference_number,
+        p.payment_date,
+        p.notes,
+        i.invoice_number,
+        i.balance_due,
+        c.name as customer_name
+    FROM payments p
+    JOIN invoices i ON p.invoice_id = i.id
+    JOIN customers c ON i.customer_id = c.id
+    {where_clause}
+    ORDER BY p.payment_date DESC, p.id DESC
+    LIMIT ? OFFSET ?
+"""
+PAYMENTS_COUNT_SQL = """
+    SELECT COUNT(*) as total 
+    FROM payments p
+    JOIN invoices i ON p.invoice_id = i.id
+    WHERE i.user_id = ?
+"""
+DELETE_PAYMENT_SQL = "DELETE FROM payments WHERE id = ?"
+INSERT_PAYMENT_SQL = """
+    INSERT INTO payments (
+        id, invoice_id, amount, payment_method, reference_number, payment_date, notes
+    ) VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+# SET expressions see the pre-update row, so the new amount_paid is written out as amount_paid + ?
+APPLY_PAYMENT_SQL = """
+    UPDATE invoices 
+    SET amount_paid = amount_paid + ?,
+        balance_due = total_amount - (amount_paid + ?),
+        status = CASE 
+            WHEN total_amount <= amount_paid + ? THEN 'paid'
+            ELSE status 
+        END,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = ?
+"""
+
+# Serializes id allocation within this process when it takes separate requests
+_id_sequence_lock = threading.Lock()
 
 class DatabaseManager:
     """Interface to your MyRDBMS database"""
     
     def __init__(self, db_name='invoicing_db'):
         self.db_name = db_name
-        self.base_url = f"{DB_API_BASE}/databases/{db_name}"
+        self.base_url = f"{DB_BASE_URL}/databases/{db_name}"
+        
+        # Endpoint URLs are fixed for the manager's lifetime, so build them once
+        self.exists_url = self.base_url
+        self.create_url = f"{DB_BASE_URL}/databases"
+        self.health_url = f"{DB_BASE_URL}/health"
+        self.execute_url = f"{self.base_url}/execute"
+        self.batch_url = f"{self.base_url}/execute_batch"
         self.initialized = False
         self.initializing = False
+        self._has_batch = None  # Unknown until the batch endpoint is first tried
+        
+        # Schema facts discovered at runtime, remembered so they are probed only once
+        self.schema_ready = set()  # Tables known to exist, so callers can skip probing
+        self.users_insert_template = None  # Index of the users INSERT form that works
+        self.supports_window_functions = None  # Unknown until COUNT(*) OVER() is first tried
+        self.supports_case_aggregates = None  # Unknown until SUM(CASE ...) is first tried
+        
+        # Last health check result, reused for HEALTH_CHECK_TTL seconds
+        self._health_cached = False
+        self._health_cached_at = 0.0
+        
+        # Reuse keep-alive connections to MyRDBMS instead of opening a new
+        # TCP connection for every query. MyRDBMS is a single host, so one
+        # connection pool, big enough for every request and query thread.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=50, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
     
     def database_exists(self):
         """Check if database exists"""
         try:
-            response = requests.get(f"{DB_API_BASE}/databases/{self.db_name}", timeout=5)
+            response = self.session.get(self.exists_url, timeout=(DB_CONNECT_TIMEOUT, 5))
             return response.status_code == 200
         except Exception as e:
             return False
@@ -46,10 +338,10 @@ class DatabaseManager:
         
         try:
             logger.info(f"Creating database '{self.db_name}'...")
-            response = requests.post(
-                f"{DB_API_BASE}/databases",
+            response = self.session.post(
+                self.create_url,
                 json={'name': self.db_name},
-                timeout=10
+                timeout=(DB_CONNECT_TIMEOUT, 10)
             )
             
             if response.status_code == 201:
@@ -63,20 +355,140 @@ class DatabaseManager:
             logger.error(f"Error creating database: {e}")
             return False
     
-    def execute(self, query):
-        """Execute a SQL query"""
+    def execute(self, query, params=None):
+        """Execute a SQL query, binding params to its ? placeholders"""
         try:
+            if params is not None:
+                query = bind_params(query, params)
+            
             # Try to execute query
-            response = requests.post(
-                f"{self.base_url}/execute",
-                json={'query': query},
-                timeout=10
+            response = self.session.post(
+                self.execute_url,
+                data=orjson.dumps({'query': query}),
+                headers=JSON_HEADERS,
+                timeout=(DB_CONNECT_TIMEOUT, 10)
             )
-            return response.json()
+            return orjson.loads(response.content)
         except Exception as e:
             logger.error(f"Database error: {e}")
             return {'success': False, 'error': str(e)}
     
+    def execute_many(self, statements, transaction=False):
+        """Execute several SQL statements in a single round-trip
+        
+        Each statement is a SQL string or a (sql, params) tuple. Falls back to one
+        request per statement if MyRDBMS has no batch endpoint. Returns one result
+        dict per statement, in order.
+        
+        With transaction=True the batch asks MyRDBMS to apply the statements
+        atomically (one commit for the lot); in the one-by-one fallback, execution
+        stops at the first failure and the remaining statements are reported as skipped.
+        """
+        statements = [bind_params(*statement) if isinstance(statement, tuple) else statement
+                      for statement in statements]
+        
+        if self._has_batch is not False:
+            batch = {'queries': statements}
+            if transaction:
+                batch['transaction'] = True
+            try:
+                response = self.session.post(
+                    self.batch_url,
+                    data=orjson.dumps(batch),
+                    headers=JSON_HEADERS,
+                    timeout=(DB_CONNECT_TIMEOUT, 30)
+                )
+                
+                if response.status_code in (404, 405):
+                    logger.info("Batch endpoint not available, executing statements one by one")
+                    self._has_batch = False
+                else:
+                    self._has_batch = True
+                    payload = orjson.loads(response.content)
+                    results = payload.get('results') if isinstance(payload, dict) else payload
+                    if isinstance(results, list) and len(results) == len(statements):
+                        return results
+                    
+                    error = payload.get('error', 'Invalid batch response') if isinstance(payload, dict) else 'Invalid batch response'
+                    logger.error(f"Batch execution failed: {error}")
+                    return [{'success': False, 'error': error} for _ in statements]
+            except Exception as e:
+                logger.error(f"Database error: {e}")
+                return [{'success': False, 'error': str(e)} for _ in statements]
+        
+        results = []
+        for statement in statements:
+            result = self.execute(statement)
+            results.append(result)
+            if transaction and not result.get('success'):
+                skipped = {'success': False, 'error': 'Skipped after an earlier statement failed'}
+                results += [skipped] * (len(statements) - len(results))
+                break
+        return results
+    
+    def execute_parallel(self, queries):
+        """Execute independent read-only queries concurrently, results in order
+        
+        Each query is a SQL string or a (sql, params) tuple.
+        """
+        return list(_query_pool.map(
+            lambda query: self.execute(*query) if isinstance(query, tuple) else self.execute(query),
+            queries
+        ))
+    
+    def _allocate_id(self, table_name, count):
+        """Advance an existing id_sequences row by count; returns the new last_id or None"""
+        statements = [
+            (NEXT_ID_UPDATE_SQL, [count, table_name]),
+            (NEXT_ID_SELECT_SQL, [table_name])
+        ]
+        if self._has_batch:
+            # Increment and read back in one round-trip. This is only atomic if MyRDBMS
+            # honours the batch's transaction flag.
+            _, result = self.execute_many(statements, transaction=True)
+        else:
+            # Without the batch endpoint these are two requests, so keep this process's
+            # other threads out from between them. Another worker process can still
+            # interleave, which is why INSERTs retry on duplicate keys (see is_duplicate_key).
+            with _id_sequence_lock:
+                _, result = self.execute_many(statements, transaction=True)
+        if result.get('data'):
+            return int(result['data'][0]['last_id'])
+        return None
+    
+    def next_id(self, table_name, count=1):
+        """Allocate the next id for table_name from the id_sequences table
+        
+        With count > 1 a block of consecutive ids is reserved and the first one is
+        returned. Returns None if no id could be allocated.
+        """
+        last_id = self._allocate_id(table_name, count)
+        if last_id is not None:
+            return last_id - count + 1
+        
+        # No sequence row yet (first use of this table): seed it once from MAX(id)
+        logger.info(f"Seeding id sequence for '{table_name}'")
+        self.execute("CREATE TABLE IF NOT EXISTS id_sequences (name VARCHAR(50) PRIMARY KEY, last_id INT NOT NULL)")
+        
+        max_result = self.execute(f"SELECT MAX(id) as max_id FROM {table_name}")
+        if not max_result.get('success'):
+            logger.error(f"Could not read max id of '{table_name}': {max_result.get('error')}")
+            return None
+        
+        max_id = max_result['data'][0].get('max_id') if max_result.get('data') else None
+        next_id = int(max_id or 0) + 1
+        
+        seed_result = self.execute("INSERT INTO id_sequences VALUES (?, ?)", [table_name, next_id + count - 1])
+        if seed_result.get('success'):
+            return next_id
+        
+        # Another request may have seeded the row first; allocate from it instead
+        last_id = self._allocate_id(table_name, count)
+        if last_id is None:
+            logger.error(f"Could not seed id sequence for '{table_name}': {seed_result.get('error')}")
+            return None
+        return last_id - count + 1
+    
     def table_exists(self, table_name):
         """Check if a specific table exists"""
         try:
@@ -110,55 +522,60 @@ class DatabaseManager:
             
             # Step 2: Read and execute the schema
             try:
-                with open('database/init.sql', 'r') as f:
-                    sql_content = f.read()
+                sql_content = read_sql_file('database/init.sql')
             except FileNotFoundError:
                 logger.error("init.sql file not found")
                 self.initializing = False
                 return False
             
             # Split into individual statements
-            statements = []
-            current_statement = []
+            statements = split_sql(sql_content)
             
-            for line in sql_content.split('\n'):
-                line = line.strip()
-                if not line or line.startswith('--'):  # Skip empty lines and comments
-                    continue
-                
-                current_statement.append(line)
-                
-                if line.endswith(';'):
-                    full_statement = ' '.join(current_statement)
-                    statements.append(full_statement)
-                    current_statement = []
-            
-            # Add any remaining statement
-            if current_statement:
-                statements.append(' '.join(current_statement))
+            # Another worker (or an earlier run) may already have applied this exact script
+            schema_version = hashlib.sha256(sql_content.encode()).hexdigest()
+            if not force and self.execute(SCHEMA_VERSION_SQL, [schema_version]).get('data'):
+                logger.info("Schema already applied, skipping init.sql")
+                self.schema_ready |= {match.group(1).lower() for match in map(CREATE_TABLE_RE.match, statements) if match}
+                self.initialized = True
+                self.initializing = False
+                return True
             
-            # Step 3: Execute each statement
+            # Step 3: Execute all statements in one batch
             success_count = 0
             total_statements = len(statements)
             
-            for i, statement in enumerate(statements, 1):
-                logger.info(f"Executing statement {i}/{total_statements}: {statement[:50]}...")
-                result = self.execute(statement)
+            logger.info(f"Executing {total_statements} schema statements...")
+            results = self.execute_many(statements)
+            
+            created_tables = set()
+            
+            for statement, result in zip(statements, results):
+                table_match = CREATE_TABLE_RE.match(statement)
                 
                 if result.get('success'):
                     success_count += 1
+                    if table_match:
+                        created_tables.add(table_match.group(1).lower())
                 else:
                     error = result.get('error', 'Unknown error')
                     # Check if error is because table already exists (that's usually fine)
                     if 'already exists' in str(error).lower() or 'duplicate' in str(error).lower():
                         success_count += 1
+                        if table_match:
+                            created_tables.add(table_match.group(1).lower())
                         logger.warning(f"Table may already exist: {error}")
                     else:
-                        logger.error(f"Failed to execute statement: {error}")
+                        logger.error(f"Failed to execute statement '{statement[:50]}...': {error}")
+            
+            self.schema_ready |= created_tables
             
             logger.info(f"Database initialization complete: {success_count}/{total_statements} statements successful")
             
             if success_count >= total_statements * 0.8:  # 80% success rate is acceptable
+                # Callers hold the init lock, so the next worker sees this before deciding
+                record_result = self.execute(RECORD_SCHEMA_VERSION_SQL, [schema_version])
+                if not record_result.get('success') and not is_duplicate_key(record_result):
+                    logger.warning(f"Could not record schema version: {record_result.get('error')}")
                 self.initialized = True
                 self.initializing = False
                 return True
@@ -171,17 +588,223 @@ class DatabaseManager:
             self.initializing = False
             return False
     
-    def health_check(self):
-        """Check if MyRDBMS is accessible"""
+    def health_check(self, force=False):
+        """Check if MyRDBMS is accessible (cached for a couple of seconds)"""
+        now = time.monotonic()
+        if not force and now - self._health_cached_at < HEALTH_CHECK_TTL:
+            return self._health_cached
+        
         try:
             # Check if we can connect to MyRDBMS
-            response = requests.get(f"{DB_API_BASE}/health", timeout=3)
-            return response.status_code == 200
+            response = self.session.get(self.health_url, timeout=3)
+            healthy = response.status_code == 200
         except Exception as e:
-            return False
+            healthy = False
+        
+        self._health_cached = healthy
+        self._health_cached_at = now
+        return healthy
+
+# (unix second, formatted timestamp) of the last now_sql() call
+_last_timestamp = (0, '')
+
+def now_sql():
+    """Current local time as 'YYYY-MM-DD HH:MM:SS', formatted at most once per second"""
+    global _last_timestamp
+    seconds = int(time.time())
+    cached_seconds, formatted = _last_timestamp
+    if seconds != cached_seconds:
+        formatted = datetime.fromtimestamp(seconds).isoformat(' ')
+        # Tuple assignment is atomic, so concurrent callers never see a torn pair
+        _last_timestamp = (seconds, formatted)
+    return formatted
+
+# Placeholder-split SQL templates, keyed by SQL text
+_sql_template_cache = {}
+
+# Doubles single quotes and backslashes and drops NUL bytes in one C-level pass, so a
+# trailing backslash can't escape the closing quote on servers that treat it specially
+_SQL_ESCAPE_TABLE = str.maketrans({"'": "''", '\\': '\\\\', '\x00': None})
+
+def sql_literal(value):
+    """Render a Python value as a SQL literal"""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + str(value).translate(_SQL_ESCAPE_TABLE) + "'"
+
+def bind_params(query, params):
+    """Bind params to the ? placeholders in query
+    
+    MyRDBMS takes plain SQL text, so values are escaped and inlined client-side.
+    """
+    parts = _sql_template_cache.get(query)
+    if parts is None:
+        parts = query.split('?')
+        _sql_template_cache[query] = parts
+    
+    if len(parts) - 1 != len(params):
+        raise ValueError(f"Expected {len(parts) - 1} SQL parameters, got {len(params)}")
+    
+    bound = [parts[0]]
+    for value, part in zip(params, parts[1:]):
+        bound.append(sql_literal(value))
+        bound.append(part)
+    return ''.join(bound)
+
+# Matches a "--" line comment up to the end of the line
+SQL_COMMENT_RE = re.compile(r'--[^\n]*')
+
+def keyset_condition(sort_column, id_column, descending=False):
+    """WHERE condition for rows after a (sort value, id) cursor
+    
+    Binds as [sort_value, sort_value, id]. Written out with OR rather than a row
+    comparison, which MyRDBMS doesn't support.
+    """
+    op = '<' if descending else '>'
+    return f"({sort_column} {op} ? OR ({sort_column} = ? AND {id_column} {op} ?))"
+
+def read_sql_file(path):
+    """Read a UTF-8 SQL file by decoding a read-only memory map of it"""
+    with open(path, 'rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return str(mapped, 'utf-8')
+        except ValueError:  # Empty files can't be mapped
+            return ''
+
+# Captures the table name of a CREATE TABLE statement
+CREATE_TABLE_RE = re.compile(r'\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', re.IGNORECASE)
+
+def split_sql(sql_content):
+    """Split a SQL script into individual statements
+    
+    Assumes ';' and '--' don't appear inside string literals, which holds for init.sql.
+    """
+    sql_content = SQL_COMMENT_RE.sub('', sql_content)
+    return [statement.strip() + ';' for statement in sql_content.split(';') if statement.strip()]
+
+class TTLCache:
+    """Small thread-safe in-memory cache whose entries expire after a TTL"""
+    
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return the cached value, or None if missing or expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+    
+    def set(self, key, value, ttl=None):
+        """Store a value, evicting the oldest entry when full"""
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.maxsize:
+                self._data.pop(next(iter(self._data)))
+            self._data[key] = (value, time.monotonic() + ttl)
+    
+    def pop(self, key):
+        """Drop a key if present"""
+        with self._lock:
+            self._data.pop(key, None)
+
+# Worker threads used to overlap independent read queries (see execute_parallel)
+_query_pool = ThreadPoolExecutor(max_workers=DB_CONCURRENCY, thread_name_prefix='db-query')
+
+# Writes nobody waits on (last_login, session cleanup) run here, off the response path
+_BG_EXEC = ThreadPoolExecutor(max_workers=4, thread_name_prefix='bg-db')
+atexit.register(_BG_EXEC.shutdown)
+
+def _log_background_failure(future):
+    """Log background writes that failed, since nobody reads their result"""
+    try:
+        result = future.result()
+    except Exception as e:
+        logger.warning(f"Background query raised: {e}")
+        return
+    if not result.get('success'):
+        logger.warning(f"Background query failed: {result.get('error')}")
+
+def run_in_background(fn, *args):
+    """Run fn(*args), which returns a query result dict, on the background executor"""
+    _BG_EXEC.submit(fn, *args).add_done_callback(_log_background_failure)
+
+def execute_in_background(query, params=None):
+    """Run a fire-and-forget query on the background executor"""
+    run_in_background(db.execute, query, params)
 
 db = DatabaseManager()
 
+# Validated sessions keyed by session_id, so navigation doesn't hit the DB every request
+session_cache = TTLCache(maxsize=10000, ttl=SESSION_CACHE_TTL)
+
+# Per-user {(page, filters...): total} dicts for list pagination
+count_cache = TTLCache(maxsize=10000, ttl=COUNT_CACHE_TTL)
+
+def user_totals(user_id):
+    """The user's cached list totals (a dict the caller may add to)"""
+    totals = count_cache.get(user_id)
+    if totals is None:
+        totals = {}
+        count_cache.set(user_id, totals)
+    return totals
+
+def cached_total(user_id, key, count_query, params):
+    """Match count for a list page, counted at most once per COUNT_CACHE_TTL"""
+    totals = user_totals(user_id)
+    if key not in totals:
+        count_result = db.execute(count_query, params)
+        if not count_result.get('data'):
+            return 0
+        totals[key] = int(count_result['data'][0].get('total') or 0)
+    return totals[key]
+
+def is_duplicate_key(result):
+    """Whether a failed statement was rejected for a duplicate key, e.g. an id already taken"""
+    if result.get('success'):
+        return False
+    error = str(result.get('error') or '').lower()
+    return 'duplicate' in error or 'unique' in error or 'already exists' in error
+
+def invalidate_totals(user_id):
+    """Forget the user's list totals in this worker after they add or remove rows"""
+    count_cache.pop(user_id)
+
+# GET /api/customers results per user. This worker drops its entry when the user's customers
+# change; other workers catch up within CUSTOMER_OPTIONS_TTL.
+customer_options_cache = TTLCache(maxsize=1024, ttl=CUSTOMER_OPTIONS_TTL)
+
+# Stored Argon2 hash -> (random salt, SHA-256 of salt + password) after a successful verify.
+# Keyed by the stored hash, so a changed password never matches a stale entry.
+credentials_cache = TTLCache(maxsize=10000, ttl=CREDENTIALS_CACHE_TTL)
+
+def joins_supported():
+    """Whether MyRDBMS can run the invoice list JOIN, probed once per process"""
+    if app.config.get('JOINS_OK') is None:
+        if db.execute(JOIN_PROBE_SQL).get('success'):
+            app.config['JOINS_OK'] = True
+        elif db.health_check():
+            # Only remember a failure MyRDBMS itself reported, not an outage
+            app.config['JOINS_OK'] = False
+        else:
+            return False
+    return app.config['JOINS_OK']
+
 def initialize_application():
     """Initialize application and database"""
     logger.info("=" * 50)
@@ -191,13 +814,17 @@ def initialize_application():
     # Check if MyRDBMS is running
     logger.info("Checking MyRDBMS connection...")
     
-    if db.health_check():
+    if db.health_check(force=True):
         logger.info("✅ MyRDBMS is running")
         
         # Try to initialize database
         logger.info("Initializing database...")
         if db.init_database():
             logger.info("✅ Database initialized successfully")
+            if joins_supported():
+                logger.info("✅ JOIN queries are supported")
+            else:
+                logger.info("⚠️ JOIN queries not supported, invoice lists will use simple queries")
         else:
             logger.warning("⚠️ Database initialization had issues")
     else:
@@ -209,9 +836,44 @@ def initialize_application():
     logger.info("App is ready! Visit http://localhost:8000")
     logger.info("=" * 50)
 
-# Start initialization in background thread
-init_thread = threading.Thread(target=initialize_application, daemon=True)
-init_thread.start()
+# Lazy initialization state for this process
+_init_lock = threading.Lock()
+_next_init_attempt = 0.0
+
+@contextmanager
+def init_file_lock():
+    """Serialize schema initialization across worker processes"""
+    os.makedirs(app.instance_path, mode=0o700, exist_ok=True)
+    # Never follow a symlink planted at the lock path, and never truncate it
+    fd = os.open(INIT_LOCK_FILE, os.O_CREAT | os.O_RDWR | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+    with os.fdopen(fd, 'r+') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+@app.before_request
+def lazy_initialize():
+    """Initialize the database on the first request this process handles"""
+    global _next_init_attempt
+    
+    if db.initialized or request.endpoint in ('static', 'favicon', 'health'):
+        return
+    if time.monotonic() < _next_init_attempt:
+        return
+    
+    with _init_lock:
+        if db.initialized or time.monotonic() < _next_init_attempt:
+            return
+        
+        with init_file_lock():
+            initialize_application()
+        
+        if not db.initialized:
+            _next_init_attempt = time.monotonic() + INIT_RETRY_INTERVAL
 
 # Add static file serving routes
 @app.route('/favicon.ico')
@@ -224,76 +886,99 @@ def favicon():
         favicon_data = base64.b64decode(b"iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAYAAAAf8/9hAAAAAXNSR0IArs4c6QAAAARnQU1BAACxjwv8YQUAAAAJcEhZcwAADsMAAA7DAcdvqGQAAAA2SURBVDhPYxgFgxiwjAI0AQYGRjScVjAqANQAoAEYGRnRcFpBmglgYmIahZQAAH8GA0J0Oxh5AAAAAElFTkSuQmCC")
         return favicon_data, 200, {'Content-Type': 'image/x-icon'}
 
-@app.route('/static/<path:filename>')
-def static_files(filename):
-    """Serve static files"""
-    return send_from_directory('static', filename)
-
 # Authentication utilities
-# Update the hash_password and verify_password functions:
+
+# Argon2id with a per-password salt: ~64 MiB and 3 passes per hash
+password_hasher = PasswordHasher(time_cost=3, memory_cost=65536, parallelism=1, hash_len=32, salt_len=16)
 
 def hash_password(password):
-    """Hash password - match the demo user's hash format"""
-    # The demo user has this hash: d3ad9315b7be5dd53b31a273b3b3aba5defe700808305aa16a3062b76658a791
-    # This looks like SHA-256 without salt
-    hash_obj = hashlib.sha256(password.encode())
-    return hash_obj.hexdigest()
+    """Hash password with Argon2id ('$argon2id$v=19$...' encoded string)"""
+    return password_hasher.hash(password)
 
 def verify_password(stored_hash, password):
-    """Verify password - simple SHA-256 without salt"""
+    """Verify password against an Argon2 hash or a legacy unsalted SHA-256 hex digest"""
+    if isinstance(stored_hash, str) and stored_hash.startswith('$argon2'):
+        # Recently verified: a salted SHA-256 stands in for the (deliberately slow) Argon2
+        cached = credentials_cache.get(stored_hash)
+        if cached:
+            salt, digest = cached
+            if hmac.compare_digest(hashlib.sha256(salt + password.encode()).digest(), digest):
+                return True
+        
+        try:
+            password_hasher.verify(stored_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        
+        salt = secrets.token_bytes(16)
+        credentials_cache.set(stored_hash, (salt, hashlib.sha256(salt + password.encode()).digest()))
+        return True
+    
+    # Accounts created before Argon2 store a plain SHA-256 hex digest
     try:
-        test_hash = hashlib.sha256(password.encode()).hexdigest()
-        return stored_hash == test_hash
-    except:
+        digest = hashlib.sha256(password.encode()).digest()
+        target = bytes.fromhex(stored_hash)
+    except (TypeError, ValueError, AttributeError):
         return False
+    return hmac.compare_digest(digest, target)
+
+def upgrade_password_hash(user_id, password):
+    """Store a fresh Argon2 hash of password for the user"""
+    return db.execute(UPDATE_PASSWORD_HASH_SQL, [hash_password(password), user_id])
+
+def password_needs_rehash(stored_hash):
+    """True for legacy SHA-256 hashes and Argon2 hashes with outdated parameters"""
+    if not stored_hash.startswith('$argon2'):
+        return True
+    try:
+        return password_hasher.check_needs_rehash(stored_hash)
+    except InvalidHashError:
+        return True
     
 def create_session(user_id, ip_address=None, user_agent=None):
-    # Check if sessions table exists
-    table_check_query = "SELECT 1 FROM sessions LIMIT 1"
-    table_check_result = db.execute(table_check_query)
-    
-    # If table doesn't exist (query fails), create it
-    if not table_check_result.get('success'):
-        logger.info("Sessions table doesn't exist, creating it...")
-        
-        # Create users table with proper schema
-        create_table_query = """
-            CREATE TABLE sessions (
-                session_id VARCHAR(255) PRIMARY KEY,
-                user_id INT NOT NULL,
-                created_at DATETIME NOT NULL,
-                expires_at DATETIME NOT NULL,
-                ip_address VARCHAR(45),
-                user_agent TEXT
-            )
-        """
-        
-        create_table_result = db.execute(create_table_query)
-        
-        if not create_table_result.get('success'):
-            logger.error(f"Failed to create users table: {create_table_result.get('error')}")
-                
     """Create a new session"""
-    session_id = secrets.token_urlsafe(32)
-    expires_at = datetime.now() + timedelta(hours=24)
-    expires_str = expires_at.strftime('%Y-%m-%d %H:%M:%S')
-    created_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    
-    # Positional INSERT for sessions table
-    # Columns: session_id, user_id, created_at, expires_at, ip_address, user_agent
-    query = f"""
-        INSERT INTO sessions VALUES (
-            '{session_id}', 
-            {user_id}, 
-            '{created_str}', 
-            '{expires_str}', 
-            '{ip_address or ''}', 
-            '{user_agent or ''}'
-        )
-    """
+    # Check if sessions table exists, unless schema initialization already confirmed it
+    if 'sessions' not in db.schema_ready:
+        table_check_query = "SELECT 1 FROM sessions LIMIT 1"
+        table_check_result = db.execute(table_check_query)
+        
+        # If table doesn't exist (query fails), create it
+        if not table_check_result.get('success'):
+            logger.info("Sessions table doesn't exist, creating it...")
+            
+            # Create sessions table with proper schema
+            create_table_query = """
+                CREATE TABLE sessions (
+                    session_id VARCHAR(255) PRIMARY KEY,
+                    user_id INT NOT NULL,
+                    created_at DATETIME NOT NULL,
+                    expires_at DATETIME NOT NULL,
+                    ip_address VARCHAR(45),
+                    user_agent TEXT
+                )
+            """
+            
+            create_table_result = db.execute(create_table_query)
+            
+            if create_table_result.get('success'):
+                db.schema_ready.add('sessions')
+            else:
+                logger.error(f"Failed to create sessions table: {create_table_result.get('error')}")
+        else:
+            db.schema_ready.add('sessions')
     
-    logger.info(f"Creating session: {query[:100]}...")
-    result = db.execute(query)
+    session_id = secrets.token_urlsafe(32)
+    params = [
+        session_id,
+        user_id,
+        now_sql(),
+        (datetime.now() + timedelta(hours=24)).isoformat(' ', 'seconds'),
+        ip_address or '',
+        user_agent or ''
+    ]
+    
+    logger.info(f"Creating session for user {user_id}")
+    result = db.execute(CREATE_SESSION_SQL, params)
     
     if result.get('success'):
         return session_id
@@ -303,18 +988,24 @@ def create_session(user_id, ip_address=None, user_agent=None):
 
 def validate_session(session_id):
     """Validate session and return user data"""
-    query = f"""
-        SELECT s.*, u.id as user_id, u.username, u.email, u.full_name, u.company_name
-        FROM sessions s
-        JOIN users u ON s.user_id = u.id
-        WHERE s.session_id = '{session_id}'
-        AND s.expires_at > '{datetime.now().isoformat()}'
-        AND u.is_active = TRUE
-    """
+    user_data = session_cache.get(session_id)
+    if user_data is not None:
+        return user_data
     
-    result = db.execute(query)
+    result = db.execute(VALIDATE_SESSION_SQL, [session_id, now_sql()])
     if result.get('success') and result.get('data'):
-        return result['data'][0]
+        user_data = result['data'][0]
+        
+        # Never trust the cached entry past the session's own expiry
+        ttl = SESSION_CACHE_TTL
+        try:
+            expires_at = datetime.fromisoformat(str(user_data.get('expires_at')))
+            ttl = min(ttl, expires_at.timestamp() - time.time())
+        except ValueError:
+            pass
+        
+        session_cache.set(session_id, user_data, ttl=ttl)
+        return user_data
     return None
 
 def login_required(f):
@@ -380,8 +1071,7 @@ def login_action():
         logger.info(f"Login attempt for email: {email}")
         
         # Find user by email
-        query = f"SELECT * FROM users WHERE email = '{email}' AND is_active = TRUE"
-        result = db.execute(query)
+        result = db.execute(LOGIN_USER_SQL, [email])
         
         if not result.get('success'):
             logger.error(f"Database error: {result.get('error')}")
@@ -401,6 +1091,11 @@ def login_action():
             logger.warning(f"Invalid password for user: {user['email']}")
             return jsonify({'success': False, 'error': 'Invalid email or password'}), 401
         
+        # Upgrade legacy or outdated hashes now that we have the plaintext; both the
+        # (slow) hashing and the write happen off the response path
+        if password_needs_rehash(user['password_hash']):
+            run_in_background(upgrade_password_hash, user['id'], password)
+        
         # Create session
         session_id = create_session(
             user['id'],
@@ -411,12 +1106,8 @@ def login_action():
         if not session_id:
             return jsonify({'success': False, 'error': 'Failed to create session'}), 500
         
-        # Update last login
-        last_login = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        db.execute(f"""
-            UPDATE users SET last_login = '{last_login}'
-            WHERE id = {user['id']}
-        """)
+        # last_login is advisory, so don't hold the response for it
+        execute_in_background(UPDATE_LAST_LOGIN_SQL, [user['id']])
         
         response_data = {
             'success': True,
@@ -481,67 +1172,70 @@ def register_action():
         # ============================================
         # CRITICAL: Ensure users table exists first!
         # ============================================
-        logger.info("Checking if users table exists...")
-        
-        # First, try to create the database if it doesn't exist
-        
-        # Check if users table exists
-        table_check_query = "SELECT 1 FROM users LIMIT 1"
-        table_check_result = db.execute(table_check_query)
-        
-        # If table doesn't exist (query fails), create it
-        if not table_check_result.get('success'):
-            logger.info("Users table doesn't exist, creating it...")
+        # Only probe when schema initialization hasn't already confirmed the table
+        if 'users' not in db.schema_ready:
+            logger.info("Checking if users table exists...")
             
-            # Create users table with proper schema
-            create_table_query = """
-                CREATE TABLE users (
-                    id INT PRIMARY KEY,
-                    username VARCHAR(50),
-                    email VARCHAR(100),
-                    password_hash VARCHAR(255),
-                    full_name VARCHAR(100),
-                    company_name VARCHAR(100),
-                    created_at TIMESTAMP,
-                    last_login TIMESTAMP,
-                    is_active BOOLEAN
-                )
-            """
-            
-            create_table_result = db.execute(create_table_query)
+            # Check if users table exists
+            table_check_query = "SELECT 1 FROM users LIMIT 1"
+            table_check_result = db.execute(table_check_query)
+        
+            # If table doesn't exist (query fails), create it
+            if not table_check_result.get('success'):
+                logger.info("Users table doesn't exist, creating it...")
             
-            if not create_table_result.get('success'):
-                logger.error(f"Failed to create users table: {create_table_result.get('error')}")
-                
-                # Try simpler table creation
-                simple_table_query = """
+                # Create users table with proper schema
+                create_table_query = """
                     CREATE TABLE users (
-                        id INT,
+                        id INT PRIMARY KEY,
                         username VARCHAR(50),
                         email VARCHAR(100),
                         password_hash VARCHAR(255),
                         full_name VARCHAR(100),
-                        company_name VARCHAR(100)
+                        company_name VARCHAR(100),
+                        created_at TIMESTAMP,
+                        last_login TIMESTAMP,
+                        is_active BOOLEAN
                     )
                 """
+            
+                create_table_result = db.execute(create_table_query)
+            
+                if not create_table_result.get('success'):
+                    logger.error(f"Failed to create users table: {create_table_result.get('error')}")
+                
+                    # Try simpler table creation
+                    simple_table_query = """
+                        CREATE TABLE users (
+                            id INT,
+                            username VARCHAR(50),
+                            email VARCHAR(100),
+                            password_hash VARCHAR(255),
+                            full_name VARCHAR(100),
+                            company_name VARCHAR(100)
+                        )
+                    """
                 
-                simple_result = db.execute(simple_table_query)
-                if not simple_result.get('success'):
-                    return jsonify({
-                        'success': False, 
-                        'error': f'Failed to create users table: {simple_result.get("error")}'
-                    }), 500
+                    simple_result = db.execute(simple_table_query)
+                    if not simple_result.get('success'):
+                        return jsonify({
+                            'success': False, 
+                            'error': f'Failed to create users table: {simple_result.get("error")}'
+                        }), 500
                 
-                logger.info("Created simplified users table")
+                    logger.info("Created simplified users table")
+            
+            db.schema_ready.add('users')
         
         # ============================================
         # Now continue with registration logic
         # ============================================
         
         # Check if user exists
-        check_query = f"SELECT id FROM users WHERE email = '{email}' OR username = '{username}'"
-        logger.info(f"Checking if user exists: {check_query}")
-        check_result = db.execute(check_query)
+        check_query = "SELECT id FROM users WHERE email = ? OR username = ?"
+        check_params = [email, username]
+        logger.info(f"Checking if user exists: {email} / {username}")
+        check_result = db.execute(check_query, check_params)
         
         logger.info(f"Check result: {check_result}")
         
@@ -553,7 +1247,7 @@ def register_action():
             if 'no such table' in error_msg.lower() or 'table' in error_msg.lower():
                 # Table might have just been created, try the check again
                 logger.info("Table was just created, retrying user check...")
-                check_result = db.execute(check_query)
+                check_result = db.execute(check_query, check_params)
                 
                 if not check_result.get('success'):
                     error_msg = check_result.get('error', 'Unknown database error')
@@ -572,59 +1266,61 @@ def register_action():
         password_hash = hash_password(password)
         logger.info(f"Password hash created: {password_hash[:30]}...")
         
-        # Get next user ID - handle case where table is empty
-        id_query = "SELECT MAX(id) as max_id FROM users"
-        logger.info(f"Getting max user ID: {id_query}")
-        id_result = db.execute(id_query)
-        
-        logger.info(f"ID result: {id_result}")
-        
-        if not id_result.get('success'):
-            # If we can't query the table, start with ID 1
-            user_id = 1
-            logger.info(f"Could not get max ID, using default: {user_id}")
-        else:
-            # Check if we got valid data
-            if id_result.get('data') and len(id_result['data']) > 0:
-                max_id = id_result['data'][0].get('max_id')
-                if max_id is None:
-                    user_id = 1
-                else:
-                    user_id = int(max_id) + 1
+        # Retry with a fresh ID if another process took this one in between; a taken
+        # username or email fails every attempt and is reported below
+        for _ in range(ID_ALLOCATION_ATTEMPTS):
+            # Allocate the user ID from the users sequence
+            user_id = db.next_id('users')
+            if user_id is None:
+                return jsonify({'success': False, 'error': 'Could not allocate user ID'}), 500
+            logger.info(f"Allocated user ID: {user_id}")
+            
+            # Create user using POSITIONAL INSERT syntax
+            # Try different INSERT formats until one works
+            
+            # Try different INSERT approaches
+            insert_attempts = [
+                # Full INSERT with all columns
+                ("INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, NULL, TRUE)",
+                 [user_id, username, email, password_hash, full_name, company_name]),
+            
+                # INSERT without timestamps (let DB use defaults)
+                ("INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)",
+                 [user_id, username, email, password_hash, full_name, company_name]),
+            
+                # Minimal INSERT
+                ("INSERT INTO users (id, username, email, password_hash) VALUES (?, ?, ?, ?)",
+                 [user_id, username, email, password_hash])
+            ]
+            
+            # Once an INSERT form is known to work, only send that one
+            if db.users_insert_template is not None:
+                attempt_indexes = [db.users_insert_template]
             else:
-                user_id = 1
-            logger.info(f"Calculated user ID: {user_id}")
-        
-        # Create user using POSITIONAL INSERT syntax
-        # Try different INSERT formats until one works
-        
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Try different INSERT approaches
-        insert_attempts = [
-            # Full INSERT with all columns
-            f"INSERT INTO users VALUES ({user_id}, '{username}', '{email}', '{password_hash}', '{full_name}', '{company_name}', '{current_time}', NULL, TRUE)",
+                attempt_indexes = range(len(insert_attempts))
             
-            # INSERT without timestamps (let DB use defaults)
-            f"INSERT INTO users VALUES ({user_id}, '{username}', '{email}', '{password_hash}', '{full_name}', '{company_name}')",
+            create_result = None
+            last_error = None
             
-            # Minimal INSERT
-            f"INSERT INTO users (id, username, email, password_hash) VALUES ({user_id}, '{username}', '{email}', '{password_hash}')"
-        ]
-        
-        create_result = None
-        last_error = None
-        
-        for attempt, insert_query in enumerate(insert_attempts, 1):
-            logger.info(f"Insert attempt {attempt}: {insert_query[:80]}...")
-            create_result = db.execute(insert_query)
+            for index in attempt_indexes:
+                attempt = index + 1
+                insert_query, insert_params = insert_attempts[index]
+                logger.info(f"Insert attempt {attempt}: {insert_query[:80]}...")
+                create_result = db.execute(insert_query, insert_params)
             
-            if create_result.get('success'):
-                logger.info(f"Insert succeeded on attempt {attempt}")
+                if create_result.get('success'):
+                    logger.info(f"Insert succeeded on attempt {attempt}")
+                    db.users_insert_template = index
+                    break
+                else:
+                    last_error = create_result.get('error')
+                    logger.warning(f"Insert attempt {attempt} failed: {last_error}")
+                    # Another INSERT form won't help if the key is taken
+                    if is_duplicate_key(create_result):
+                        break
+            
+            if create_result.get('success') or not is_duplicate_key(create_result):
                 break
-            else:
-                last_error = create_result.get('error')
-                logger.warning(f"Insert attempt {attempt} failed: {last_error}")
         
         # Check if any insert worked
         if not create_result or not create_result.get('success'):
@@ -661,7 +1357,8 @@ def register_action():
 def logout():
     session_id = request.cookies.get('session_id')
     if session_id:
-        db.execute(f"DELETE FROM sessions WHERE session_id = '{session_id}'")
+        session_cache.pop(session_id)
+        execute_in_background(DELETE_SESSION_SQL, [session_id])
     
     response = redirect(url_for('login_page'))
     response.delete_cookie('session_id')
@@ -674,7 +1371,7 @@ def dashboard():
     user = request.user
     user_id = user['user_id']
     
-    # Get stats using separate queries (MyRDBMS doesn't support nested SELECT)
+    # Get stats with flat aggregate queries (MyRDBMS doesn't support nested SELECT)
     stats = {
         'customer_count': 0,
         'invoice_count': 0,
@@ -682,63 +1379,49 @@ def dashboard():
         'total_paid': 0
     }
     
+    # Invoice stats in one scan when SUM(CASE ...) works, otherwise one filtered query each
+    if db.supports_case_aggregates is False:
+        invoice_queries = [DASHBOARD_INVOICE_COUNT_SQL, DASHBOARD_OUTSTANDING_SQL, DASHBOARD_PAID_SQL]
+    else:
+        invoice_queries = [DASHBOARD_INVOICE_STATS_SQL]
+    
+    # All dashboard queries are independent, so run them concurrently
+    customer_result, recent_result, *invoice_results = db.execute_parallel(
+        [(DASHBOARD_CUSTOMER_COUNT_SQL, [user_id]), (DASHBOARD_RECENT_INVOICES_SQL, [user_id])]
+        + [(query, [user_id]) for query in invoice_queries]
+    )
+    
+    if db.supports_case_aggregates is not False and not invoice_results[0].get('success'):
+        logger.warning(f"Dashboard invoice stats failed: {invoice_results[0].get('error')}")
+        if db.supports_case_aggregates is None and db.health_check():
+            # Only remember a failure MyRDBMS itself reported, not an outage
+            logger.info("CASE inside aggregates not supported, summing invoice stats separately")
+            db.supports_case_aggregates = False
+            invoice_results = db.execute_parallel([
+                (DASHBOARD_INVOICE_COUNT_SQL, [user_id]),
+                (DASHBOARD_OUTSTANDING_SQL, [user_id]),
+                (DASHBOARD_PAID_SQL, [user_id])
+            ])
+    elif len(invoice_results) == 1:
+        db.supports_case_aggregates = True
+    
     # 1. Customer count
-    customer_count_query = f"SELECT COUNT(*) as count FROM customers WHERE user_id = '{user_id}'"
-    customer_result = db.execute(customer_count_query)
     if customer_result.get('data'):
-        # Extract count - handle different column names
         row = customer_result['data'][0]
-        for key, value in row.items():
-            if 'count' in key.lower() or isinstance(value, (int, float)):
-                stats['customer_count'] = int(value) if value else 0
-                break
-    
-    # 2. Invoice count
-    invoice_count_query = f"SELECT COUNT(*) as count FROM invoices WHERE user_id = '{user_id}'"
-    invoice_result = db.execute(invoice_count_query)
-    if invoice_result.get('data'):
-        row = invoice_result['data'][0]
-        for key, value in row.items():
-            if 'count' in key.lower() or isinstance(value, (int, float)):
-                stats['invoice_count'] = int(value) if value else 0
-                break
+        stats['customer_count'] = int(row.get('customer_count') or 0)
     
-    # 3. Total outstanding (invoices not paid)
-    outstanding_query = f"""
-        SELECT SUM(balance_due) as total 
-        FROM invoices 
-        WHERE user_id = '{user_id}' AND status != 'paid'
-    """
-    outstanding_result = db.execute(outstanding_query)
-    if outstanding_result.get('data'):
-        row = outstanding_result['data'][0]
-        for key, value in row.items():
-            if 'total' in key.lower() or isinstance(value, (int, float)):
-                stats['total_outstanding'] = float(value) if value else 0
-                break
-    
-    # 4. Total paid
-    paid_query = f"""
-        SELECT SUM(total_amount) as total 
-        FROM invoices 
-        WHERE user_id = '{user_id}' AND status = 'paid'
-    """
-    paid_result = db.execute(paid_query)
-    if paid_result.get('data'):
-        row = paid_result['data'][0]
-        for key, value in row.items():
-            if 'total' in key.lower() or isinstance(value, (int, float)):
-                stats['total_paid'] = float(value) if value else 0
-                break
+    # 2. Invoice count, outstanding (not paid) and paid totals
+    invoice_row = {}
+    for result in invoice_results:
+        if result.get('data'):
+            invoice_row.update(result['data'][0])
+    stats['invoice_count'] = int(invoice_row.get('invoice_count') or 0)
+    stats['total_outstanding'] = float(invoice_row.get('total_outstanding') or 0)
+    stats['total_paid'] = float(invoice_row.get('total_paid') or 0)
     
     logger.info(f"📊 Dashboard stats: {stats}")
     
     # Get recent invoices
-    recent_invoices_query = f"""
-        SELECT * FROM invoices i JOIN customers c ON i.customer_id = c.id
-    """
-    
-    recent_result = db.execute(recent_invoices_query)
     recent_invoices = recent_result.get('data', [])
     
     return render_template('dashboard.html', 
@@ -753,62 +1436,86 @@ def customers():
     user_id = request.user['user_id']
     page = request.args.get('page', 1, type=int)
     search = request.args.get('search', '')
+    after_name = request.args.get('after_name')
+    after_id = request.args.get('after_id', type=int)
     
     # Build query
-    where_clause = f"WHERE user_id = {user_id}"
+    where_clause = "WHERE user_id = ?"
+    where_params = [user_id]
     if search:
-        where_clause += f" AND (name LIKE '%{search}%' OR email LIKE '%{search}%')"
+        where_clause += " AND (name LIKE ? OR email LIKE ?)"
+        where_params += [f"%{search}%", f"%{search}%"]
     
-    # Count total
-    count_query = f"SELECT COUNT(*) as total FROM customers {where_clause}"
-    count_result = db.execute(count_query)
-    #total = count_result['data'][0]['total'] if count_result.get('data') else 0
-
-    # Safer extraction
-    if count_result.get('data') and len(count_result['data']) > 0:
-        count_row = count_result['data'][0]
-        # Try multiple possible keys
-        if 'total' in count_row:
-            total = count_row['total']
-        elif 'count' in count_row:
-            total = count_row['count']
-        elif 'COUNT(*)' in count_row:
-            total = count_row['COUNT(*)']
-        else:
-            # Use the first value that looks like a number
-            for key, value in count_row.items():
-                if isinstance(value, (int, float)):
-                    total = value
-                    break
-                elif isinstance(value, str):
-                    try:
-                        total = int(value)
-                        break
-                    except:
-                        continue
-            else:
-                total = 0
+    # Get paginated customers, one extra row to tell whether a next page exists
+    limit = 20
+    totals = user_totals(user_id)
+    total_key = ('customers', search)
+    total = totals.get(total_key)
+    customers_list = None
+    
+    if after_name is not None and after_id is not None:
+        # Seek past the previous page's last row instead of skipping with OFFSET
+        seek_clause = f"{where_clause} AND {keyset_condition('name', 'id')}"
+        page_query = CUSTOMERS_PAGE_SQL.format(where_clause=seek_clause)
+        page_params = where_params + [after_name, after_name, after_id, limit + 1, 0]
     else:
-        total = 0
+        page = max(1, min(page, MAX_OFFSET_PAGE))
+        page_query = CUSTOMERS_PAGE_SQL.format(where_clause=where_clause)
+        page_params = where_params + [limit + 1, (page - 1) * limit]
+        
+        # Fetch the page and the total match count in one round-trip when possible
+        if total is None and db.supports_window_functions is not False:
+            window_query = CUSTOMERS_PAGE_WITH_TOTAL_SQL.format(where_clause=where_clause)
+            page_result = db.execute(window_query, page_params)
+            
+            if page_result.get('success'):
+                db.supports_window_functions = True
+                customers_list = page_result.get('data', [])
+                if customers_list:
+                    total = int(customers_list[0].get('total') or 0)
+                elif page == 1:
+                    total = 0
+                for customer in customers_list:
+                    customer.pop('total', None)
+            elif db.supports_window_functions is None and db.health_check():
+                # Only remember a failure MyRDBMS itself reported, not an outage
+                logger.info("Window functions not supported, counting customers separately")
+                db.supports_window_functions = False
+    
+    count_query = CUSTOMERS_COUNT_SQL.format(where_clause=where_clause)
+    if customers_list is None:
+        if total is None:
+            # The page and the count don't depend on each other, so run them side by side
+            customers_result, count_result = db.execute_parallel([
+                (page_query, page_params),
+                (count_query, where_params)
+            ])
+            if count_result.get('data'):
+                total = int(count_result['data'][0].get('total') or 0)
+        else:
+            customers_result = db.execute(page_query, page_params)
+        customers_list = customers_result.get('data', [])
+    elif total is None:
+        # Window query returned an empty page past the end, so it carried no total
+        count_result = db.execute(count_query, where_params)
+        if count_result.get('data'):
+            total = int(count_result['data'][0].get('total') or 0)
     
-    # Get paginated customers
-    limit = 20
-    offset = (page - 1) * limit
-    customers_query = f"""
-        SELECT * FROM customers 
-        {where_clause}
-        ORDER BY name
-        LIMIT {limit} OFFSET {offset}
-    """
+    if total is not None:
+        totals[total_key] = total
     
-    customers_result = db.execute(customers_query)
-    customers_list = customers_result.get('data', [])
+    next_cursor = {}
+    if len(customers_list) > limit:
+        customers_list = customers_list[:limit]
+        last = customers_list[-1]
+        next_cursor = {'after_name': last['name'], 'after_id': last['id']}
     
     return render_template('customers.html',
                          customers=customers_list,
                          page=page,
-                         total=total,
-                         search=search)
+                         total=total or 0,
+                         search=search,
+                         next_cursor=next_cursor)
 
 @app.route('/api/customers', methods=['GET', 'POST', 'PUT', 'DELETE'])
 @login_required
@@ -817,99 +1524,80 @@ def api_customers():
     
     if request.method == 'GET':
         # Get all customers for dropdowns
-        query = f"""
-            SELECT id, name, email FROM customers 
-            WHERE user_id = {user_id}
-            ORDER BY name
-        """
-        result = db.execute(query)
+        result = customer_options_cache.get(user_id)
+        if result is None:
+            result = db.execute(CUSTOMER_OPTIONS_SQL, [user_id])
+            if result.get('success'):
+                customer_options_cache.set(user_id, result)
         return jsonify(result)
     
     elif request.method == 'POST':
 
-        # Check if customers table exists
-        table_check_query = "SELECT 1 FROM customers LIMIT 1"
-        table_check_result = db.execute(table_check_query)
-        
-        # If table doesn't exist (query fails), create it
-        if not table_check_result.get('success'):
-            logger.info("Customers table doesn't exist, creating it...")
+        # Check if customers table exists, unless schema initialization already confirmed it
+        if 'customers' not in db.schema_ready:
+            table_check_query = "SELECT 1 FROM customers LIMIT 1"
+            table_check_result = db.execute(table_check_query)
             
-            # Create customers table with proper schema
-            create_table_query = """
-                CREATE TABLE customers (
-                    id INT PRIMARY KEY,
-                    user_id INT NOT NULL,
-                    name VARCHAR(100) NOT NULL,
-                    email VARCHAR(100),
-                    phone VARCHAR(20),
-                    address TEXT,
-                    city VARCHAR(50),
-                    country VARCHAR(50),
-                    tax_id VARCHAR(50),
-                    notes TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """
-            
-            create_table_result = db.execute(create_table_query)
-            
-            if not create_table_result.get('success'):
-                logger.error(f"Failed to create customers table: {create_table_result.get('error')}")
+            # If table doesn't exist (query fails), create it
+            if not table_check_result.get('success'):
+                logger.info("Customers table doesn't exist, creating it...")
+                
+                # Create customers table with proper schema
+                create_table_query = """
+                    CREATE TABLE customers (
+                        id INT PRIMARY KEY,
+                        user_id INT NOT NULL,
+                        name VARCHAR(100) NOT NULL,
+                        email VARCHAR(100),
+                        phone VARCHAR(20),
+                        address TEXT,
+                        city VARCHAR(50),
+                        country VARCHAR(50),
+                        tax_id VARCHAR(50),
+                        notes TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """
+                
+                create_table_result = db.execute(create_table_query)
+                
+                if create_table_result.get('success'):
+                    db.schema_ready.add('customers')
+                else:
+                    logger.error(f"Failed to create customers table: {create_table_result.get('error')}")
+            else:
+                db.schema_ready.add('customers')
                 
         data = request.json
         
-        # Get next customer ID
-        id_query = "SELECT COALESCE(MAX(id), 0) + 1 as next_id FROM customers"
-        id_result = db.execute(id_query)
-        #customer_id = id_result['data'][0]['next_id'] if id_result.get('data') else 1
-        # SAFE extraction with multiple fallbacks
-        customer_id = 1
-        if id_result.get('data') and len(id_result['data']) > 0:
-            row = id_result['data'][0]
-            # Try all possible column names
-            if 'next_id' in row:
-                customer_id = row['next_id']
-            elif 'NEXT_ID' in row:
-                customer_id = row['NEXT_ID']
-            elif 'coalesce(max(id),0)+1' in row:  # Raw column name
-                customer_id = row['coalesce(max(id),0)+1']
-            else:
-                # Use first numeric value found
-                for value in row.values():
-                    if isinstance(value, (int, float)):
-                        customer_id = int(value)
-                        break
-                    elif isinstance(value, str):
-                        try:
-                            customer_id = int(value)
-                            break
-                        except:
-                            continue
-
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Positional INSERT for customers table
-        # Columns: id, user_id, name, email, phone, address, city, country, tax_id, notes, created_at, updated_at
-        query = f"""
-            INSERT INTO customers VALUES (
-                {customer_id}, 
-                {user_id}, 
-                '{data['name']}', 
-                '{data.get('email', '')}', 
-                '{data.get('phone', '')}', 
-                '{data.get('address', '')}', 
-                '{data.get('city', '')}', 
-                '{data.get('country', '')}',
-                '{data.get('tax_id', '')}', 
-                '{data.get('notes', '')}', 
-                '{current_time}', 
-                '{current_time}'
-            )
-        """
+        for _ in range(ID_ALLOCATION_ATTEMPTS):
+            # Get next customer ID
+            customer_id = db.next_id('customers')
+            if customer_id is None:
+                return jsonify({'success': False, 'error': 'Could not allocate customer ID'}), 500
+            
+            # Positional INSERT for customers table
+            # Columns: id, user_id, name, email, phone, address, city, country, tax_id, notes, created_at, updated_at
+            result = db.execute(INSERT_CUSTOMER_SQL, [
+                customer_id,
+                user_id,
+                data['name'],
+                data.get('email', ''),
+                data.get('phone', ''),
+                data.get('address', ''),
+                data.get('city', ''),
+                data.get('country', ''),
+                data.get('tax_id', ''),
+                data.get('notes', '')
+            ])
+            # A taken id means another process allocated it in between; try a fresh one
+            if not is_duplicate_key(result):
+                break
         
-        result = db.execute(query)
+        if result.get('success'):
+            invalidate_totals(user_id)
+            customer_options_cache.pop(user_id)
         return jsonify(result)
     
     elif request.method == 'PUT':
@@ -917,40 +1605,40 @@ def api_customers():
         customer_id = data['id']
         
         # Verify ownership
-        check_query = f"SELECT id FROM customers WHERE id = {customer_id} AND user_id = {user_id}"
-        check_result = db.execute(check_query)
+        check_result = db.execute(CUSTOMER_OWNER_SQL, [customer_id, user_id])
         
         if not check_result.get('data'):
             return jsonify({'success': False, 'error': 'Customer not found'}), 404
         
-        query = f"""
-            UPDATE customers SET
-                name = '{data['name']}',
-                email = '{data.get('email', '')}',
-                phone = '{data.get('phone', '')}',
-                address = '{data.get('address', '')}',
-                city = '{data.get('city', '')}',
-                country = '{data.get('country', '')}',
-                tax_id = '{data.get('tax_id', '')}',
-                notes = '{data.get('notes', '')}',
-                updated_at = '{datetime.now().isoformat()}'
-            WHERE id = {customer_id}
-        """
-        result = db.execute(query)
+        result = db.execute(UPDATE_CUSTOMER_SQL, [
+            data['name'],
+            data.get('email', ''),
+            data.get('phone', ''),
+            data.get('address', ''),
+            data.get('city', ''),
+            data.get('country', ''),
+            data.get('tax_id', ''),
+            data.get('notes', ''),
+            customer_id
+        ])
+        if result.get('success'):
+            invalidate_totals(user_id)
+            customer_options_cache.pop(user_id)
         return jsonify(result)
     
     elif request.method == 'DELETE':
-        customer_id = request.args.get('id')
+        customer_id = request.args.get('id', type=int)
         
         # Verify ownership
-        check_query = f"SELECT id FROM customers WHERE id = {customer_id} AND user_id = {user_id}"
-        check_result = db.execute(check_query)
+        check_result = db.execute(CUSTOMER_OWNER_SQL, [customer_id, user_id])
         
         if not check_result.get('data'):
             return jsonify({'success': False, 'error': 'Customer not found'}), 404
         
-        query = f"DELETE FROM customers WHERE id = {customer_id}"
-        result = db.execute(query)
+        result = db.execute(DELETE_CUSTOMER_SQL, [customer_id])
+        if result.get('success'):
+            invalidate_totals(user_id)
+            customer_options_cache.pop(user_id)
         return jsonify(result)
 
 # Page 4: Invoices
@@ -961,6 +1649,8 @@ def invoices():
     page = request.args.get('page', 1, type=int)
     status = request.args.get('status', '')
     search = request.args.get('search', '')
+    after_date = request.args.get('after_date')
+    after_id = request.args.get('after_id', type=int)
     
     logger.info(f"📄 Invoices page - User ID: {user_id}")
     
@@ -969,32 +1659,31 @@ def invoices():
     # ============================================
     
     # Simple query to get invoices
-    base_where = f"WHERE user_id = '{user_id}'"
+    base_where = "WHERE user_id = ?"
+    base_params = [user_id]
     if status:
-        base_where += f" AND status = '{status}'"
-    
-    # First, check if we can do JOINs by testing a simple JOIN
-    test_join_query = f"""
-        SELECT i.id 
-        FROM invoices i 
-        JOIN customers c ON i.customer_id = c.id 
-        WHERE i.user_id = '{user_id}' 
-        LIMIT 1
-    """
-    test_join_result = db.execute(test_join_query)
+        base_where += " AND status = ?"
+        base_params.append(status)
     
     invoices_list = []
     total = 0
+    next_cursor = {}
     
-    if test_join_result.get('success') and test_join_result.get('data'):
-        logger.info("✅ JOIN queries are supported")
-        
+    # JOIN support is checked once per process, not on every page load
+    if joins_supported():
         # Build WHERE clause for JOIN queries
-        where_clause = f"WHERE i.user_id = '{user_id}'"  # FIX: Added quotes
+        where_clause = "WHERE i.user_id = ?"
+        where_params = [user_id]
         if status:
-            where_clause += f" AND i.status = '{status}'"
-        if search:
-            where_clause += f" AND (i.invoice_number LIKE '%{search}%' OR c.name LIKE '%{search}%')"
+            where_clause += " AND i.status = ?"
+            where_params.append(status)
+        if search.upper().startswith(INVOICE_NUMBER_PREFIX):
+            # Looks like an invoice number: a prefix match can use the invoice_number index
+            where_clause += " AND i.invoice_number LIKE ?"
+            where_params.append(f"{search.upper()}%")
+        elif search:
+            where_clause += " AND (i.invoice_number LIKE ? OR c.name LIKE ?)"
+            where_params += [f"%{search}%", f"%{search}%"]
         
         # Count total
         if search:
@@ -1005,99 +1694,76 @@ def invoices():
                 JOIN customers c ON i.customer_id = c.id
                 {where_clause}
             """
+            count_params = where_params
         else:
             # Without search, simple count
             count_query = f"SELECT COUNT(*) as total FROM invoices {base_where}"
+            count_params = base_params
         
-        count_result = db.execute(count_query)
-        logger.info(f"🔍 Count query result: {count_result}")
+        total = cached_total(user_id, ('invoices', status, search), count_query, count_params)
         
-        # Extract total safely
-        if count_result.get('data') and len(count_result['data']) > 0:
-            count_row = count_result['data'][0]
-            for key, value in count_row.items():
-                if 'total' in key.lower() or isinstance(value, (int, float)):
-                    total = int(value) if value else 0
-                    break
-        
-        # Get paginated invoices - SIMPLIFIED without nested SELECT
+        # Get paginated invoices, one extra row to tell whether a next page exists
         limit = 20
-        offset = (page - 1) * limit
+        page_clause = where_clause
+        page_params = list(where_params)
+        if after_date is not None and after_id is not None:
+            # Seek past the previous page's last row instead of skipping with OFFSET
+            page_clause += f" AND {keyset_condition('i.issue_date', 'i.id', descending=True)}"
+            page_params += [after_date, after_date, after_id]
+            offset = 0
+        else:
+            page = max(1, min(page, MAX_OFFSET_PAGE))
+            offset = (page - 1) * limit
+        
         invoices_query = f"""
             SELECT 
-                i.*,
-                c.name as customer_name,
-                c.email as customer_email
-                -- Removed: (SELECT COUNT(*) FROM invoice_items WHERE invoice_id = i.id) as item_count
+                i.id,
+                i.invoice_number,
+                i.issue_date,
+                i.due_date,
+                i.total_amount,
+                i.balance_due,
+                i.status,
+                c.name as customer_name
             FROM invoices i
             JOIN customers c ON i.customer_id = c.id
-            {where_clause}
+            {page_clause}
             ORDER BY i.issue_date DESC, i.id DESC
-            LIMIT {limit} OFFSET {offset}
+            LIMIT ? OFFSET ?
         """
         
         logger.info(f"🔍 Invoices query: {invoices_query[:200]}...")
-        invoices_result = db.execute(invoices_query)
+        invoices_result = db.execute(invoices_query, page_params + [limit + 1, offset])
         invoices_list = invoices_result.get('data', [])
         
-        # Get item counts separately if needed
-        if invoices_list:
-            for invoice in invoices_list:
-                invoice_id = invoice.get('id')
-                if invoice_id:
-                    item_count_query = f"SELECT COUNT(*) as count FROM invoice_items WHERE invoice_id = {invoice_id}"
-                    item_result = db.execute(item_count_query)
-                    if item_result.get('data'):
-                        count_row = item_result['data'][0]
-                        for key, value in count_row.items():
-                            if 'count' in key.lower():
-                                invoice['item_count'] = int(value) if value else 0
-                                break
-                    else:
-                        invoice['item_count'] = 0
-                else:
-                    invoice['item_count'] = 0
+        if len(invoices_list) > limit:
+            invoices_list = invoices_list[:limit]
+            last = invoices_list[-1]
+            next_cursor = {'after_date': last['issue_date'], 'after_id': last['id']}
     
     else:
-        logger.info("⚠️ JOIN queries not supported, using simple queries")
-        
         # Get invoices without JOIN
-        simple_query = f"SELECT * FROM invoices {base_where} ORDER BY issue_date DESC LIMIT 20"
-        simple_result = db.execute(simple_query)
+        simple_query = f"""
+            SELECT id, customer_id, invoice_number, issue_date, due_date, total_amount, balance_due, status
+            FROM invoices {base_where}
+            ORDER BY issue_date DESC LIMIT 20
+        """
+        simple_result = db.execute(simple_query, base_params)
         invoices_list = simple_result.get('data', [])
         
         # Count total
         count_query = f"SELECT COUNT(*) as total FROM invoices {base_where}"
-        count_result = db.execute(count_query)
-        if count_result.get('data'):
-            count_row = count_result['data'][0]
-            for key, value in count_row.items():
-                if 'total' in key.lower():
-                    total = int(value) if value else 0
-                    break
+        total = cached_total(user_id, ('invoices', status, ''), count_query, base_params)
         
         # Get customer info separately
         for invoice in invoices_list:
             customer_id = invoice.get('customer_id')
             if customer_id:
-                customer_query = f"SELECT name, email FROM customers WHERE id = {customer_id}"
-                customer_result = db.execute(customer_query)
+                customer_query = "SELECT name FROM customers WHERE id = ?"
+                customer_result = db.execute(customer_query, [customer_id])
                 if customer_result.get('data'):
                     customer = customer_result['data'][0]
                     invoice['customer_name'] = customer.get('name', '')
-                    invoice['customer_email'] = customer.get('email', '')
-            
-            # Get item count
-            invoice_id = invoice.get('id')
-            if invoice_id:
-                item_count_query = f"SELECT COUNT(*) as count FROM invoice_items WHERE invoice_id = {invoice_id}"
-                item_result = db.execute(item_count_query)
-                if item_result.get('data'):
-                    count_row = item_result['data'][0]
-                    for key, value in count_row.items():
-                        if 'count' in key.lower():
-                            invoice['item_count'] = int(value) if value else 0
-                            break
     
     logger.info(f"📄 Found {len(invoices_list)} invoices for user {user_id}")
     
@@ -1107,6 +1773,7 @@ def invoices():
                          total=total,
                          status=status,
                          search=search,
+                         next_cursor=next_cursor,
                          now=datetime.now)
 
 # Page 5: Invoice Detail
@@ -1117,46 +1784,26 @@ def invoice_detail(invoice_id):
     
     logger.info(f"📄 Invoice detail - Invoice ID: {invoice_id}, User ID: {user_id}")
     
-    # ============================================
-    # FIX 2: Get invoice with simple approach
-    # ============================================
-    
-    # First get the invoice
-    invoice_query = f"SELECT * FROM invoices WHERE id = {invoice_id} AND user_id = '{user_id}'"
-    invoice_result = db.execute(invoice_query)
+    # Invoice (with customer), items and payments only depend on invoice_id, so fetch
+    # them together. Items and payments are only used once ownership is confirmed.
+    invoice_result, items_result, payments_result = db.execute_parallel([
+        (INVOICE_DETAIL_SQL, [invoice_id, user_id]),
+        (INVOICE_ITEMS_SQL, [invoice_id]),
+        (INVOICE_PAYMENTS_SQL, [invoice_id])
+    ])
     
     if not invoice_result.get('data'):
         logger.warning(f"Invoice {invoice_id} not found for user {user_id}")
         return "Invoice not found", 404
     
     invoice = invoice_result['data'][0]
-    customer_id = invoice.get('customer_id')
-    
-    # Get customer info
-    customer = {'name': '', 'email': '', 'phone': '', 'address': '', 'city': '', 'country': '', 'tax_id': ''}
-    if customer_id:
-        customer_query = f"SELECT name, email, phone, address, city, country, tax_id FROM customers WHERE id = {customer_id}"
-        customer_result = db.execute(customer_query)
-        if customer_result.get('data'):
-            customer = customer_result['data'][0]
-    
-    # Merge customer info into invoice
-    invoice['customer_name'] = customer.get('name', '')
-    invoice['customer_email'] = customer.get('email', '')
-    invoice['customer_phone'] = customer.get('phone', '')
-    invoice['customer_address'] = customer.get('address', '')
-    invoice['customer_city'] = customer.get('city', '')
-    invoice['customer_country'] = customer.get('country', '')
-    invoice['customer_tax_id'] = customer.get('tax_id', '')
-    
-    # Get invoice items
-    items_query = f"SELECT * FROM invoice_items WHERE invoice_id = {invoice_id} ORDER BY id"
-    items_result = db.execute(items_query)
-    items = items_result.get('data', [])
     
-    # Get payments
-    payments_query = f"SELECT * FROM payments WHERE invoice_id = {invoice_id} ORDER BY payment_date DESC"
-    payments_result = db.execute(payments_query)
+    # Customer columns are NULL when the customer row is missing
+    for key in ('customer_name', 'customer_email', 'customer_phone', 'customer_address',
+                'customer_city', 'customer_country', 'customer_tax_id'):
+        invoice[key] = invoice.get(key) or ''
+    
+    items = items_result.get('data', [])
     payments = payments_result.get('data', [])
     
     logger.info(f"📄 Invoice {invoice_id} - Items: {len(items)}, Payments: {len(payments)}")
@@ -1172,42 +1819,40 @@ def invoice_detail(invoice_id):
 def payments():
     user_id = request.user['user_id']
     page = request.args.get('page', 1, type=int)
+    after_date = request.args.get('after_date')
+    after_id = request.args.get('after_id', type=int)
     
-    # Get payments with invoice and customer info
+    # Get payments with invoice and customer info, one extra row to tell whether a next page exists
     limit = 20
-    offset = (page - 1) * limit
-    payments_query = f"""
-        SELECT 
-            p.*,
-            i.invoice_number,
-            i.total_amount,
-            i.balance_due,
-            c.name as customer_name
-        FROM payments p
-        JOIN invoices i ON p.invoice_id = i.id
-        JOIN customers c ON i.customer_id = c.id
-        WHERE i.user_id = {user_id}
-        ORDER BY p.payment_date DESC
-        LIMIT {limit} OFFSET {offset}
-    """
+    where_clause = "WHERE i.user_id = ?"
+    page_params = [user_id]
+    if after_date is not None and after_id is not None:
+        # Seek past the previous page's last row instead of skipping with OFFSET
+        where_clause += f" AND {keyset_condition('p.payment_date', 'p.id', descending=True)}"
+        page_params += [after_date, after_date, after_id]
+        offset = 0
+    else:
+        page = max(1, min(page, MAX_OFFSET_PAGE))
+        offset = (page - 1) * limit
     
-    payments_result = db.execute(payments_query)
+    payments_query = PAYMENTS_PAGE_SQL.format(where_clause=where_clause)
+    payments_result = db.execute(payments_query, page_params + [limit + 1, offset])
     payments_list = payments_result.get('data', [])
     
+    next_cursor = {}
+    if len(payments_list) > limit:
+        payments_list = payments_list[:limit]
+        last = payments_list[-1]
+        next_cursor = {'after_date': last['payment_date'], 'after_id': last['id']}
+    
     # Count total
-    count_query = f"""
-        SELECT COUNT(*) as total 
-        FROM payments p
-        JOIN invoices i ON p.invoice_id = i.id
-        WHERE i.user_id = {user_id}
-    """
-    count_result = db.execute(count_query)
-    total = count_result['data'][0]['total'] if count_result.get('data') else 0
+    total = cached_total(user_id, ('payments',), PAYMENTS_COUNT_SQL, [user_id])
     
     return render_template('payments.html',
                          payments=payments_list,
                          page=page,
-                         total=total)
+                         total=total,
+                         next_cursor=next_cursor)
 
 # API endpoints for invoice operations
 @app.route('/api/invoices', methods=['POST'])
@@ -1233,110 +1878,76 @@ def create_invoice():
         # 1. ENSURE TABLES EXIST
         # ============================================
         
-        # Check/create invoices table
-        invoices_table_check = "SELECT 1 FROM invoices LIMIT 1"
-        invoices_table_result = db.execute(invoices_table_check)
-        
-        if not invoices_table_result.get('success'):
-            logger.info("Creating invoices table...")
-            create_invoices_table = """
-                CREATE TABLE invoices (
-                    id INT PRIMARY KEY,
-                    customer_id INT NOT NULL,
-                    user_id INT NOT NULL,
-                    invoice_number VARCHAR(50) UNIQUE NOT NULL,
-                    issue_date DATE NOT NULL,
-                    due_date DATE NOT NULL,
-                    subtotal DECIMAL(10, 2) DEFAULT 0,
-                    tax_amount DECIMAL(10, 2) DEFAULT 0,
-                    total_amount DECIMAL(10, 2) DEFAULT 0,
-                    amount_paid DECIMAL(10, 2) DEFAULT 0,
-                    balance_due DECIMAL(10, 2) DEFAULT 0,
-                    status VARCHAR(20) DEFAULT 'draft',
-                    currency VARCHAR(3) DEFAULT 'KES',
-                    notes TEXT,
-                    terms TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """
-            create_result = db.execute(create_invoices_table)
-            if not create_result.get('success'):
-                logger.error(f"Failed to create invoices table: {create_result.get('error')}")
-                return jsonify({'success': False, 'error': f'Failed to create invoices table: {create_result.get("error")}'}), 500
-        
-        # Check/create invoice_items table
-        items_table_check = "SELECT 1 FROM invoice_items LIMIT 1"
-        items_table_result = db.execute(items_table_check)
-        
-        if not items_table_result.get('success'):
-            logger.info("Creating invoice_items table...")
-            create_items_table = """
-                CREATE TABLE invoice_items (
-                    id INT PRIMARY KEY,
-                    invoice_id INT NOT NULL,
-                    description VARCHAR(255) NOT NULL,
-                    quantity DECIMAL(10, 2) DEFAULT 1,
-                    unit_price DECIMAL(10, 2) DEFAULT 0,
-                    tax_rate DECIMAL(5, 2) DEFAULT 0,
-                    amount DECIMAL(10, 2) DEFAULT 0,
-                    tax_amount DECIMAL(10, 2) DEFAULT 0,
-                    total_amount DECIMAL(10, 2) DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """
-            create_result = db.execute(create_items_table)
-            if not create_result.get('success'):
-                logger.error(f"Failed to create invoice_items table: {create_result.get('error')}")
-                return jsonify({'success': False, 'error': f'Failed to create invoice_items table: {create_result.get("error")}'}), 500
-        
-        # ============================================
-        # 2. GENERATE INVOICE NUMBER
-        # ============================================
-        
-        today = datetime.now().strftime('%Y%m%d')
-        number_query = f"SELECT COUNT(*) as count FROM invoices WHERE invoice_number LIKE 'INV-{today}-%'"
-        number_result = db.execute(number_query)
-        
-        count = 0
-        if number_result.get('data') and len(number_result['data']) > 0:
-            count_row = number_result['data'][0]
-            # Extract count from any key that contains 'count'
-            for key, value in count_row.items():
-                if 'count' in key.lower() or isinstance(value, (int, float)):
-                    count = int(value) if value else 0
-                    break
-        
-        invoice_number = f"INV-{today}-{count + 1:04d}"
-        logger.info(f"Generated invoice number: {invoice_number}")
-        
-        # ============================================
-        # 3. GET NEXT INVOICE ID
-        # ============================================
-        
-        id_query = "SELECT COALESCE(MAX(id), 0) + 1 as next_id FROM invoices"
-        id_result = db.execute(id_query)
-        
-        invoice_id = 1  # Default
-        if id_result.get('data') and len(id_result['data']) > 0:
-            id_row = id_result['data'][0]
-            # Extract next_id from any numeric value
-            for key, value in id_row.items():
-                if 'next_id' in key.lower() or isinstance(value, (int, float)):
-                    try:
-                        invoice_id = int(value) if value else 1
-                        break
-                    except:
-                        continue
-        
-        logger.info(f"Next invoice ID: {invoice_id}")
+        # Check/create invoices table, unless schema initialization already confirmed it
+        if 'invoices' not in db.schema_ready:
+            invoices_table_check = "SELECT 1 FROM invoices LIMIT 1"
+            invoices_table_result = db.execute(invoices_table_check)
+            
+            if not invoices_table_result.get('success'):
+                logger.info("Creating invoices table...")
+                create_invoices_table = """
+                    CREATE TABLE invoices (
+                        id INT PRIMARY KEY,
+                        customer_id INT NOT NULL,
+                        user_id INT NOT NULL,
+                        invoice_number VARCHAR(50) UNIQUE NOT NULL,
+                        issue_date DATE NOT NULL,
+                        due_date DATE NOT NULL,
+                        subtotal DECIMAL(10, 2) DEFAULT 0,
+                        tax_amount DECIMAL(10, 2) DEFAULT 0,
+                        total_amount DECIMAL(10, 2) DEFAULT 0,
+                        amount_paid DECIMAL(10, 2) DEFAULT 0,
+                        balance_due DECIMAL(10, 2) DEFAULT 0,
+                        status VARCHAR(20) DEFAULT 'draft',
+                        currency VARCHAR(3) DEFAULT 'KES',
+                        notes TEXT,
+                        terms TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """
+                create_result = db.execute(create_invoices_table)
+                if not create_result.get('success'):
+                    logger.error(f"Failed to create invoices table: {create_result.get('error')}")
+                    return jsonify({'success': False, 'error': f'Failed to create invoices table: {create_result.get("error")}'}), 500
+            db.schema_ready.add('invoices')
+        
+        # Check/create invoice_items table, unless schema initialization already confirmed it
+        if 'invoice_items' not in db.schema_ready:
+            items_table_check = "SELECT 1 FROM invoice_items LIMIT 1"
+            items_table_result = db.execute(items_table_check)
+            
+            if not items_table_result.get('success'):
+                logger.info("Creating invoice_items table...")
+                create_items_table = """
+                    CREATE TABLE invoice_items (
+                        id INT PRIMARY KEY,
+                        invoice_id INT NOT NULL,
+                        description VARCHAR(255) NOT NULL,
+                        quantity DECIMAL(10, 2) DEFAULT 1,
+                        unit_price DECIMAL(10, 2) DEFAULT 0,
+                        tax_rate DECIMAL(5, 2) DEFAULT 0,
+                        amount DECIMAL(10, 2) DEFAULT 0,
+                        tax_amount DECIMAL(10, 2) DEFAULT 0,
+                        total_amount DECIMAL(10, 2) DEFAULT 0,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """
+                create_result = db.execute(create_items_table)
+                if not create_result.get('success'):
+                    logger.error(f"Failed to create invoice_items table: {create_result.get('error')}")
+                    return jsonify({'success': False, 'error': f'Failed to create invoice_items table: {create_result.get("error")}'}), 500
+            db.schema_ready.add('invoice_items')
         
         # ============================================
-        # 4. CALCULATE TOTALS
+        # 2. BUILD ITEM ROWS AND TOTALS
         # ============================================
         
+        # One pass computes each line's amounts (stored on the item row) and the invoice totals.
+        # Rows get their ids and invoice_id once those are allocated below.
         subtotal = 0
         tax_amount = 0
+        item_rows = []
         
         for item in data['items']:
             quantity = float(item.get('quantity', 0))
@@ -1348,93 +1959,106 @@ def create_invoice():
             
             subtotal += item_subtotal
             tax_amount += item_tax
+            
+            item_rows.append([
+                item['description'],
+                quantity,
+                unit_price,
+                tax_rate,
+                item_subtotal,
+                item_tax,
+                item_subtotal + item_tax
+            ])
         
         total_amount = subtotal + tax_amount
-        balance_due = total_amount  # Initially balance due equals total amount
         
         logger.info(f"Calculated totals - Subtotal: {subtotal}, Tax: {tax_amount}, Total: {total_amount}")
         
-        # ============================================
-        # 5. CREATE INVOICE
-        # ============================================
-        
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        invoice_query = f"""
-            INSERT INTO invoices VALUES (
-                {invoice_id}, 
-                {int(data['customer_id'])}, 
-                {user_id}, 
-                '{invoice_number}',
-                '{data['issue_date']}', 
-                '{data['due_date']}', 
-                {subtotal}, 
-                {tax_amount},
-                {total_amount}, 
-                0,  -- amount_paid starts at 0
-                {total_amount},  -- balance_due starts at total_amount
-                '{data.get('status', 'draft')}', 
-                '{data.get('currency', 'KES')}',
-                '{data.get('notes', '').replace("'", "''")}', 
-                '{data.get('terms', '').replace("'", "''")}',
-                '{current_time}', 
-                '{current_time}'
-            )
-        """
-        
-        logger.info(f"Invoice insert query: {invoice_query[:200]}...")
-        invoice_result = db.execute(invoice_query)
+        # A duplicate key means another process took the id or invoice number in between,
+        # so each attempt allocates fresh ids and a fresh number
+        for _ in range(ID_ALLOCATION_ATTEMPTS):
+            # ============================================
+            # 3. GENERATE INVOICE NUMBER
+            # ============================================
+            
+            today = datetime.now().strftime('%Y%m%d')
+            number_result = db.execute(INVOICE_NUMBER_COUNT_SQL, [f"{INVOICE_NUMBER_PREFIX}{today}-%"])
+            
+            count = 0
+            if number_result.get('data'):
+                count = int(number_result['data'][0].get('invoice_count') or 0)
+            
+            invoice_number = f"{INVOICE_NUMBER_PREFIX}{today}-{count + 1:04d}"
+            logger.info(f"Generated invoice number: {invoice_number}")
+            
+            # ============================================
+            # 4. GET NEXT INVOICE AND ITEM IDS
+            # ============================================
+            
+            invoice_id = db.next_id('invoices')
+            if invoice_id is None:
+                return jsonify({'success': False, 'error': 'Could not allocate invoice ID'}), 500
+            
+            logger.info(f"Next invoice ID: {invoice_id}")
+            
+            # Reserve a block of item IDs
+            item_start_id = db.next_id('invoice_items', count=len(item_rows))
+            if item_start_id is None:
+                return jsonify({
+                    'success': False,
+                    'error': 'Could not allocate invoice item IDs'
+                }), 500
+            
+            # ============================================
+            # 5. CREATE INVOICE AND ITEMS
+            # ============================================
+            
+            invoice_params = [
+                invoice_id,
+                int(data['customer_id']),
+                user_id,
+                invoice_number,
+                data['issue_date'],
+                data['due_date'],
+                subtotal,
+                tax_amount,
+                total_amount,
+                0,  # amount_paid starts at 0
+                total_amount,  # balance_due starts at total_amount
+                data.get('status', 'draft'),
+                data.get('currency', 'KES'),
+                data.get('notes') or '',
+                data.get('terms') or ''
+            ]
+            item_statements = [
+                (INSERT_INVOICE_ITEM_SQL, [item_start_id + idx, invoice_id, *row])
+                for idx, row in enumerate(item_rows)
+            ]
+            
+            logger.info(f"Invoice insert params: {invoice_params}")
+            
+            # The invoice and all its items go to the server in one batch, as one transaction
+            results = db.execute_many([(INSERT_INVOICE_SQL, invoice_params), *item_statements], transaction=True)
+            failed = next((result for result in results if not result.get('success')), None)
+            
+            if not failed:
+                break
+            
+            logger.error(f"Failed to create invoice: {failed.get('error')}")
+            if results[0].get('success'):
+                # The invoice row is ours: clear out anything that did get written, in case
+                # the transaction wasn't honoured. Otherwise invoice_id may belong to someone else.
+                db.execute_many([(DELETE_INVOICE_ITEMS_SQL, [invoice_id]), (DELETE_INVOICE_SQL, [invoice_id])])
+            if not is_duplicate_key(failed):
+                break
         
-        if not invoice_result.get('success'):
-            logger.error(f"Failed to create invoice: {invoice_result.get('error')}")
+        if failed:
             return jsonify({
                 'success': False,
-                'error': f'Failed to create invoice: {invoice_result.get("error")}'
+                'error': f'Failed to create invoice: {failed.get("error")}'
             }), 500
         
-        # ============================================
-        # 6. ADD INVOICE ITEMS
-        # ============================================
-        
-        # Get next item ID
-        item_id_query = "SELECT COALESCE(MAX(id), 0) + 1 as next_id FROM invoice_items"
-        item_id_result = db.execute(item_id_query)
-        
-        item_start_id = 1
-        if item_id_result.get('data') and len(item_id_result['data']) > 0:
-            id_row = item_id_result['data'][0]
-            for key, value in id_row.items():
-                if 'next_id' in key.lower() or isinstance(value, (int, float)):
-                    try:
-                        item_start_id = int(value) if value else 1
-                        break
-                    except:
-                        continue
-        
-        item_errors = []
-        for idx, item in enumerate(data['items']):
-            item_id = item_start_id + idx
-            
-            item_query = f"""
-                INSERT INTO invoice_items VALUES (
-                    {item_id}, 
-                    {invoice_id}, 
-                    '{item['description'].replace("'", "''")}', 
-                    {float(item['quantity'])}, 
-                    {float(item['unit_price'])}, 
-                    {float(item.get('tax_rate', 0))}, 
-                    '{current_time}'
-                )
-            """
-            
-            item_result = db.execute(item_query)
-            if not item_result.get('success'):
-                item_errors.append(f"Item {idx + 1}: {item_result.get('error')}")
-                logger.error(f"Failed to insert item {idx + 1}: {item_result.get('error')}")
-        
-        if item_errors:
-            logger.warning(f"Some items failed: {item_errors}")
-            # Continue anyway - invoice was created
+        invalidate_totals(user_id)
         
         logger.info(f"✅ Invoice created successfully: {invoice_number} (ID: {invoice_id})")
         
@@ -1445,8 +2069,7 @@ def create_invoice():
             'invoice_number': invoice_number,
             'total_amount': total_amount,
             'subtotal': subtotal,
-            'tax_amount': tax_amount,
-            'item_errors': item_errors if item_errors else None
+            'tax_amount': tax_amount
         })
         
     except Exception as e:
@@ -1463,48 +2086,70 @@ def record_payment(invoice_id):
     data = request.json
     
     # Verify invoice ownership
-    check_query = f"SELECT id FROM invoices WHERE id = {invoice_id} AND user_id = {user_id}"
-    check_result = db.execute(check_query)
+    check_result = db.execute(INVOICE_OWNER_SQL, [invoice_id, user_id])
     
     if not check_result.get('data'):
         return jsonify({'success': False, 'error': 'Invoice not found'}), 404
     
-    # Get next payment ID
-    id_query = "SELECT COALESCE(MAX(id), 0) + 1 as next_id FROM payments"
-    id_result = db.execute(id_query)
-    payment_id = id_result['data'][0]['next_id'] if id_result.get('data') else 1
-    
-    # Create payment
-    payment_query = f"""
-        INSERT INTO payments (
-            id, invoice_id, amount, payment_method, reference_number, payment_date, notes
-        ) VALUES (
-            {payment_id}, {invoice_id}, {data['amount']}, '{data['payment_method']}',
-            '{data.get('reference_number', '')}', '{data['payment_date']}', 
-            '{data.get('notes', '')}'
-        )
-    """
+    # The status is settled inside the UPDATE, against the row as it is when the
+    # update lands, so concurrent partial payments can't leave a paid invoice open
+    amount = float(data['amount'])
+    
+    for _ in range(ID_ALLOCATION_ATTEMPTS):
+        # Get next payment ID
+        payment_id = db.next_id('payments')
+        if payment_id is None:
+            return jsonify({'success': False, 'error': 'Could not allocate payment ID'}), 500
+        
+        payment_result = db.execute(INSERT_PAYMENT_SQL, [
+            payment_id,
+            invoice_id,
+            amount,
+            data['payment_method'],
+            data.get('reference_number', ''),
+            data['payment_date'],
+            data.get('notes', '')
+        ])
+        
+        # Retry with a fresh id if another process took this one
+        if not is_duplicate_key(payment_result):
+            break
     
-    payment_result = db.execute(payment_query)
     if not payment_result.get('success'):
         return jsonify(payment_result), 500
     
-    # Update invoice amount_paid
-    update_query = f"""
-        UPDATE invoices 
-        SET amount_paid = amount_paid + {data['amount']},
-            status = CASE 
-                WHEN total_amount <= amount_paid + {data['amount']} THEN 'paid'
-                ELSE status 
-            END,
-            updated_at = '{datetime.now().isoformat()}'
-        WHERE id = {invoice_id}
-    """
+    # Only touch the invoice once the payment row exists. MyRDBMS can't be relied on to
+    # roll back a batch, so sending both together could credit the invoice for a payment
+    # whose INSERT failed.
+    update_result = db.execute(APPLY_PAYMENT_SQL, [amount, amount, amount, invoice_id])
     
-    db.execute(update_query)
+    if not update_result.get('success'):
+        logger.error(f"Failed to apply payment {payment_id} to invoice {invoice_id}: {update_result.get('error')}")
+        # Don't keep a payment the invoice doesn't reflect
+        db.execute(DELETE_PAYMENT_SQL, [payment_id])
+        return jsonify(update_result), 500
+    
+    invalidate_totals(user_id)
     
     return jsonify({'success': True, 'payment_id': payment_id})
 
+# Explicit warm-up / schema re-run
+@app.route('/admin/reinit', methods=['POST'])
+@login_required
+def admin_reinit():
+    user_id = request.user['user_id']
+    if user_id not in ADMIN_USER_IDS:
+        logger.warning(f"Database re-initialization refused for non-admin user {user_id}")
+        return jsonify({'success': False, 'error': 'Admin access required'}), 403
+    
+    logger.info(f"Database re-initialization requested by user {user_id}")
+    
+    # Same locks as lazy initialization, so this never overlaps another worker's init
+    with _init_lock, init_file_lock():
+        success = db.init_database(force=True)
+    
+    return jsonify({'success': success}), 200 if success else 500
+
 # Health check endpoint
 @app.route('/health')
 def health():
@@ -1536,4 +2181,5 @@ if __name__ == '__main__':
     else:
         logger.warning("Cannot connect to database")
     
-    app.run(debug=True, port=8000, host='0.0.0.0')
\ No newline at end of file
+    # Dev server only; production runs wsgi:application under gunicorn
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', port=8000, host='0.0.0.0')
\ No newline at end of file
@@ -1,44 +1,74 @@
 # config.py
 import os
+from dataclasses import dataclass
 from datetime import timedelta
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Final
 
+# Fixed for every environment; import these directly, e.g. from config import DB_BASE_URL
+DB_HOST: Final[str] = 'localhost'
+DB_PORT: Final[int] = 5000
+DB_BASE_URL: Final[str] = f'http://{DB_HOST}:{DB_PORT}/api'
+
+@lru_cache(maxsize=None)
+def _env(name, default=None):
+    """Environment variable, read on first use and remembered for the process"""
+    return os.environ.get(name) or default
+
+# Settings are resolved once into immutable instances; slots keep attribute reads cheap
+@dataclass(frozen=True, slots=True)
 class Config:
-    SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
-    SESSION_COOKIE_NAME = 'invoicing_session'
-    SESSION_COOKIE_HTTPONLY = True
-    SESSION_COOKIE_SECURE = False  # Set to True in production with HTTPS
-    PERMANENT_SESSION_LIFETIME = timedelta(hours=24)
+    SESSION_COOKIE_NAME: str = 'invoicing_session'
+    SESSION_COOKIE_HTTPONLY: bool = True
+    SESSION_COOKIE_SECURE: bool = False  # Set to True in production with HTTPS
+    PERMANENT_SESSION_LIFETIME: timedelta = timedelta(hours=24)
+    DEBUG: bool = False
     
     # Database configuration
-    DB_HOST = 'localhost'
-    DB_PORT = 5000
-    DB_BASE_URL = 'http://localhost:5000/api'
+    DB_HOST: str = DB_HOST
+    DB_PORT: int = DB_PORT
+    DB_BASE_URL: str = DB_BASE_URL
     
     # App settings
-    APP_NAME = 'Invoicing App'
-    APP_VERSION = '1.0.0'
-    CURRENCY = 'KES'  # Kenyan Shillings for Pesapal context
-    TAX_RATE = 16.0  # VAT rate in Kenya
+    APP_NAME: str = 'Invoicing App'
+    APP_VERSION: str = '1.0.0'
+    CURRENCY: str = 'KES'  # Kenyan Shillings for Pesapal context
+    TAX_RATE: float = 16.0  # VAT rate in Kenya
     
     # Email settings (optional)
-    MAIL_SERVER = 'smtp.gmail.com'
-    MAIL_PORT = 587
-    MAIL_USE_TLS = True
-    MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
-    MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_SERVER: str = 'smtp.gmail.com'
+    MAIL_PORT: int = 587
+    MAIL_USE_TLS: bool = True
     
     # Pagination
-    ITEMS_PER_PAGE = 20
+    ITEMS_PER_PAGE: int = 20
+    
+    # Environment-backed settings are only read when something asks for them
+    @property
+    def SECRET_KEY(self):
+        return _env('SECRET_KEY', 'dev-secret-key-change-in-production')
+    
+    @property
+    def MAIL_USERNAME(self):
+        return _env('MAIL_USERNAME')
+    
+    @property
+    def MAIL_PASSWORD(self):
+        return _env('MAIL_PASSWORD')
 
+@dataclass(frozen=True, slots=True)
 class DevelopmentConfig(Config):
-    DEBUG = True
+    DEBUG: bool = True
 
+@dataclass(frozen=True, slots=True)
 class ProductionConfig(Config):
-    DEBUG = False
-    SESSION_COOKIE_SECURE = True
+    DEBUG: bool = False
+    SESSION_COOKIE_SECURE: bool = True
 
-config = {
-    'development': DevelopmentConfig,
-    'production': ProductionConfig,
-    'default': DevelopmentConfig
-}
\ No newline at end of file
+# Read-only view so the environment table can't be changed at runtime
+config = MappingProxyType({
+    'development': DevelopmentConfig(),
+    'production': ProductionConfig(),
+    'default': DevelopmentConfig()
+})
@@ -83,9 +83,29 @@ CREATE TABLE IF NOT EXISTS sessions (
     user_agent TEXT
 );
 
+-- Last id handed out per table (replaces SELECT MAX(id) + 1). Rows are not seeded
+-- here: the app seeds each one from the table's MAX(id) on first use.
+CREATE TABLE IF NOT EXISTS id_sequences (
+    name VARCHAR(50) PRIMARY KEY,
+    last_id INT NOT NULL
+);
+
+-- One row per version (checksum) of this script the app has applied; workers skip
+-- the script when the current version is already recorded
+CREATE TABLE IF NOT EXISTS schema_info (
+    version VARCHAR(64) PRIMARY KEY,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Indexes matching the list pages' filters and sort orders
+CREATE INDEX IF NOT EXISTS idx_customers_user_name ON customers (user_id, name, id);
+CREATE INDEX IF NOT EXISTS idx_invoices_user_date ON invoices (user_id, issue_date, id);
+CREATE INDEX IF NOT EXISTS idx_items_invoice ON invoice_items (invoice_id);
+CREATE INDEX IF NOT EXISTS idx_payments_invoice_date ON payments (invoice_id, payment_date);
+
 -- Insert demo user (password: demo123)
 -- Positional INSERT syntax: VALUES (value1, value2, value3, ...)
-INSERT INTO users VALUES (1, 'demo', 'demo@invoicing.com', 'd3ad9315b7be5dd53b31a273b3b3aba5defe700808305aa16a3062b76658a791', 'Demo User', 'Demo Company Inc.', CURRENT_TIMESTAMP, NULL, TRUE);
+INSERT INTO users VALUES (1, 'demo', 'demo@invoicing.com', '$argon2id$v=19$m=65536,t=3,p=1$8fOPPYOsKwucEMUNQz7Njw$BXj2pDZGzVCpDiVyGgN/Ps1LEWJLGZUmK6iJ9/B8IY0', 'Demo User', 'Demo Company Inc.', CURRENT_TIMESTAMP, NULL, TRUE);
 
 -- Insert sample customers
 INSERT INTO customers VALUES (1, 1, 'Acme Corporation', 'billing@acme.com', '+254700123456', '123 Business Street', 'Nairobi', 'Kenya', 'TAX-001', 'Regular customer', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP);
@@ -12,7 +12,7 @@ pip install -r requirements.txt
 
 # Start the Flask app
 echo "🌐 Starting Flask app..."
-python3 app.py
+gunicorn -c gunicorn_conf.py wsgi:application
 
 # Run the init.sql script
 python3 -c "
@@ -0,0 +1,19 @@
+# gunicorn_conf.py - Production server settings
+# Run with: gunicorn -c gunicorn_conf.py wsgi:application
+import multiprocessing
+
+bind = '0.0.0.0:8000'
+
+# Threaded workers: requests spend most of their time waiting on MyRDBMS
+workers = multiprocessing.cpu_count() * 2 + 1
+worker_class = 'gthread'
+threads = 8
+
+timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+# Behind a reverse proxy, let it compress instead, e.g. for nginx:
+#   gzip on; gzip_types application/json text/css application/javascript;
@@ -1,2 +1,2 @@
-import hashlib
-print(hashlib.sha256("demo123".encode()).hexdigest())
\ No newline at end of file
+from argon2 import PasswordHasher
+print(PasswordHasher(time_cost=3, memory_cost=65536, parallelism=1, hash_len=32, salt_len=16).hash("demo123"))
\ No newline at end of file
@@ -1,67 +1,147 @@
 # test_rdbms.py
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import hashlib
+import hmac
+import socket
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError
+
+DEMO_PASSWORD = "demo123"
+
+# Unsalted SHA-256 digest of "demo123" from before the switch to Argon2
+LEGACY_DEMO_DIGEST = bytes.fromhex('d3ad9315b7be5dd53b31a273b3b3aba5defe700808305aa16a3062b76658a791')
+
+# Argon2id hash of "demo123" stored for the demo user in database/init.sql
+DEMO_PASSWORD_HASH = "$argon2id$v=19$m=65536,t=3,p=1$8fOPPYOsKwucEMUNQz7Njw$BXj2pDZGzVCpDiVyGgN/Ps1LEWJLGZUmK6iJ9/B8IY0"
+
+# SHA-256 of the demo password, computed once at import
+DEMO_DIGEST = hashlib.sha256(DEMO_PASSWORD.encode()).digest()
+
+BASE_URL = "http://localhost:5000/api"
+DB_NAME = "invoicing_db"
+EXECUTE_URL = f"{BASE_URL}/databases/{DB_NAME}/execute"
+BATCH_URL = f"{BASE_URL}/databases/{DB_NAME}/execute_batch"
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Test simple INSERT, read it back, then clean up
+TEST_QUERIES = [
+    "INSERT INTO users VALUES (999, 'testuser', 'test@example.com', 'hash123', 'Test User', 'Test Company', '2024-01-01', NULL, TRUE)",
+    "SELECT * FROM users WHERE id = 999",
+    "DELETE FROM users WHERE id = 999"
+]
+
+# Request bodies are encoded once, not on every run
+BATCH_PAYLOAD = orjson.dumps({'queries': TEST_QUERIES})
+QUERY_PAYLOADS = [orjson.dumps({'query': query}) for query in TEST_QUERIES]
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose sockets skip Nagle's delay and send TCP keep-alives"""
+    
+    socket_options = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    ]
+    
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
 
 def test_insert_syntax():
     """Test the correct INSERT syntax for your RDBMS"""
     
-    base_url = "http://localhost:5000/api"
-    db_name = "invoicing_db"
-    
-    # Test simple INSERT
-    test_query = "INSERT INTO users VALUES (999, 'testuser', 'test@example.com', 'hash123', 'Test User', 'Test Company', '2024-01-01', NULL, TRUE)"
+    # One keep-alive connection for all three statements
+    s = requests.Session()
+    s.mount('http://', KeepAliveAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+    s.headers['Connection'] = 'keep-alive'
     
     try:
-        response = requests.post(
-            f"{base_url}/databases/{db_name}/execute",
-            json={'query': test_query},
-            timeout=10
-        )
-        
-        result = response.json()
-        print(f"Test INSERT result: {result}")
+        # Send all three statements in one round-trip when the batch endpoint exists
+        response = s.post(BATCH_URL, data=BATCH_PAYLOAD, headers=JSON_HEADERS, timeout=10)
         
-        # Now try to select the test user
-        select_query = "SELECT * FROM users WHERE id = 999"
-        response = requests.post(
-            f"{base_url}/databases/{db_name}/execute",
-            json={'query': select_query},
-            timeout=10
-        )
+        if response.status_code in (404, 405):
+            results = [
+                orjson.loads(s.post(EXECUTE_URL, data=payload, headers=JSON_HEADERS, timeout=10).content)
+                for payload in QUERY_PAYLOADS
+            ]
+        else:
+            # Batch replies are {'results': [...]} or a bare list, as DatabaseManager.execute_many accepts
+            payload = orjson.loads(response.content)
+            results = payload.get('results') if isinstance(payload, dict) else payload
+            if not isinstance(results, list) or len(results) != len(TEST_QUERIES):
+                raise ValueError(f"Invalid batch response: {payload}")
         
-        select_result = response.json()
-        print(f"Test SELECT result: {select_result}")
-        
-        # Clean up
-        delete_query = "DELETE FROM users WHERE id = 999"
-        response = requests.post(
-            f"{base_url}/databases/{db_name}/execute",
-            json={'query': delete_query},
-            timeout=10
-        )
+        print(f"Test INSERT result: {results[0]}")
+        print(f"Test SELECT result: {results[1]}")
         
         return True
         
-    except Exception as e:
+    except (requests.RequestException, ValueError) as e:
         print(f"Error testing RDBMS: {e}")
         return False
+    
+    finally:
+        s.close()
 
 def test_password_hash():
-    """Test password hashing matches demo user"""
-    password = "demo123"
-    hash_obj = hashlib.sha256(password.encode())
-    hash_digest = hash_obj.hexdigest()
+    """Test Argon2id password hashing used for the demo user"""
+    ph = PasswordHasher(time_cost=3, memory_cost=65536, parallelism=1, hash_len=32, salt_len=16)
+    
+    password = DEMO_PASSWORD
+    encoded = ph.hash(password)
     
     print(f"\nPassword: {password}")
-    print(f"SHA-256 hash: {hash_digest}")
-    print(f"Demo user hash: d3ad9315b7be5dd53b31a273b3b3aba5defe700808305aa16a3062b76658a791")
-    print(f"Match: {hash_digest == 'd3ad9315b7be5dd53b31a273b3b3aba5defe700808305aa16a3062b76658a791'}")
+    print(f"Argon2id hash: {encoded}")
+    print(f"Demo user hash: {DEMO_PASSWORD_HASH}")
+    # verify() raises on a wrong password rather than returning False
+    try:
+        match = ph.verify(DEMO_PASSWORD_HASH, password)
+    except VerificationError:
+        match = False
+    print(f"Match: {match}")
+    
+    # Accounts created before Argon2 still carry an unsalted SHA-256 hex digest
+    print(f"Legacy SHA-256 match: {hmac.compare_digest(DEMO_DIGEST, LEGACY_DEMO_DIGEST)}")
     
-    return hash_digest
+    return encoded
+
+def test_bind_params():
+    """Test client-side ? binding used by DatabaseManager"""
+    from app import bind_params, sql_literal
+    
+    # Quotes and backslashes are doubled, NUL bytes dropped
+    assert sql_literal("O'Brien") == "'O''Brien'"
+    assert sql_literal("a\\") == "'a\\\\'"
+    assert sql_literal("nul\x00byte") == "'nulbyte'"
+    
+    # Non-strings render as bare literals
+    assert sql_literal(None) == 'NULL'
+    assert sql_literal(True) == 'TRUE'
+    assert sql_literal(False) == 'FALSE'
+    assert sql_literal(42) == '42'
+    assert sql_literal(1.5) == '1.5'
+    
+    # A ? inside a bound value is data, not another placeholder
+    bound = bind_params("SELECT * FROM customers WHERE name = ? AND id = ?", ["who?", 7])
+    print(f"Bound query: {bound}")
+    assert bound == "SELECT * FROM customers WHERE name = 'who?' AND id = 7"
+    
+    # Placeholder and parameter counts must agree
+    for params in ([], [1, 2]):
+        try:
+            bind_params("SELECT * FROM users WHERE id = ?", params)
+        except ValueError as e:
+            print(f"Rejected {params}: {e}")
+        else:
+            raise AssertionError(f"bind_params accepted {len(params)} params for 1 placeholder")
 
 if __name__ == "__main__":
     print("=== Testing RDBMS INSERT Syntax ===")
     test_insert_syntax()
     
     print("\n=== Testing Password Hash ===")
-    test_password_hash()
\ No newline at end of file
+    test_password_hash()
+    
+    print("\n=== Testing Parameter Binding ===")
+    test_bind_params()
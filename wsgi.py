@@ -0,0 +1,5 @@
+# wsgi.py - WSGI entry point for production servers
+# Run with: gunicorn -c gunicorn_conf.py wsgi:application
+from app import app as application
+
+app = application